@@ -1,15 +1,28 @@
 import imgaug as ia
 import imgaug.augmenters as iaa
-from imgaug.augmentables.bbs import BoundingBox, BoundingBoxesOnImage
+from imgaug.augmentables.bbs import BoundingBoxesOnImage
 import cv2
 import os
 import zipfile
 import csv
-import copy as cp
 import xml.etree.ElementTree as ET
 import argparse
 import time
 import shutil
+import math
+import multiprocessing
+import collections
+import json
+import hashlib
+import posixpath
+import threading
+import glob
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from xml.sax.saxutils import escape
+import numpy as np
+from zip_utils import (
+    ANNOTATION_DIR, IMAGE_DIR, copy_raw_member, image_member,
+    is_annotation_member, merge_zip, recover_zip, write_member)
 
 
 def get_all_file_paths(directory):
@@ -25,54 +38,1344 @@ def get_all_file_paths(directory):
     return file_paths
 
 
+# Steps shared by several augmentations: (operation, *arguments)
+DARKEN = ('multiply', 0.7, 0.8)
+BRIGHTEN = ('multiply', 1.4, 1.6)
+BLUR = ('blur', 2)
+GRAYSCALE = ('grayscale',)
+
+# Predefined augmentations, one per command line flag. Each maps to the
+# suffix of its output files and the chain of steps that produces it.
+AUGMENTATIONS = collections.OrderedDict([
+    ('rotate_180', ('_rotate_180', (('rot90', 2),))),
+    ('darken', ('_darkened', (DARKEN,))),
+    ('rotate_90_darken', ('_darkened_rotate_90', (DARKEN, ('rot90', 1)))),
+    ('rotate_180_darken', ('_darkened_rotate_180', (DARKEN, ('rot90', 2)))),
+    ('brighten', ('_brightened', (BRIGHTEN,))),
+    ('rotate_brighten', ('_brightened_rotate_180', (BRIGHTEN, ('rot90', 2)))),
+    ('blur', ('_blurred', (BLUR,))),
+    ('rotate_180_blur', ('_blurred_rotate_180', (BLUR, ('rot90', 2)))),
+    ('rotate_270_darken', ('_rotate_270_darkened', (DARKEN, ('rot90', 3)))),
+    ('grayscale', ('_grayscale', (GRAYSCALE,))),
+    ('rotate_90_grayscale', (
+        '_rotate_90_grayscale', (GRAYSCALE, ('rot90', 1)))),
+    ('rotate_180_grayscale', (
+        '_rotate_180_grayscale', (GRAYSCALE, ('rot90', 2)))),
+    ('grayscale_darken', ('_grayscale_darkened', (DARKEN, GRAYSCALE))),
+    ('grayscale_brighten', ('_grayscale_brightened', (BRIGHTEN, GRAYSCALE))),
+    ('grayscale_blur', ('_grayscale_blurred', (BLUR, GRAYSCALE))),
+    ('rotate_270_grayscale', (
+        '_rotate_270_grayscale', (GRAYSCALE, ('rot90', 3)))),
+    ('zoom', ('_zoomed', (('zoom', 0.6, 1.0),))),
+])
+
+
+# Builders for every augmentation step, keyed by operation name. Adding an
+# entry here makes the operation available to pipeline specs.
+STEP_BUILDERS = {
+    'rot90': lambda k: iaa.Rot90(int(k)),
+    'multiply': lambda low, high: iaa.Multiply((low, high)),
+    'blur': lambda sigma: iaa.GaussianBlur(sigma),
+    'grayscale': lambda: iaa.color.ChangeColorspace("GRAY"),
+    'zoom': lambda low, high: iaa.Affine(
+        scale={"x": (low, high), "y": (low, high)}),
+}
+
+
+def derive_seed(*parts):
+    """
+    Derives a 32-bit seed from a base seed and the identity of what is being
+    augmented, so it doesn't depend on the process or the processing order
+    :param parts: JSON serializable values, starting with the base seed
+    :return: the derived seed
+    """
+    digest = hashlib.sha1(json.dumps(list(parts)).encode('utf-8')).digest()
+    return int.from_bytes(digest[:4], "little")
+
+
+class ImgaugStep:
+    """
+    Runs an imgaug augmenter on an image and an (N, 4) array of x1, y1, x2,
+    y2 box coordinates. Every step takes an optional seed; without one,
+    random parameters come from imgaug's global random state.
+    """
+    def __init__(self, augmenter):
+        self.augmenter = augmenter
+
+    def __call__(self, image, boxes, seed=None):
+        if seed is not None:
+            # augmenters are shared between graph nodes but only run one at
+            # a time, so reseeding in place is enough
+            self.augmenter.seed_(seed)
+        bbs = BoundingBoxesOnImage.from_xyxy_array(boxes, shape=image.shape)
+        image, bbs = self.augmenter(image=image, bounding_boxes=bbs)
+        return image, bbs.to_xyxy_array()
+
+
+class FastRot90:
+    """
+    Clockwise rotation by k * 90 degrees with closed-form box coordinates.
+    Like iaa.Rot90, odd rotations are resized back to the input size.
+    """
+    def __init__(self, k):
+        self.k = int(k) % 4
+
+    def __call__(self, image, boxes, seed=None):
+        if self.k == 0:
+            return image, boxes
+        height, width = image.shape[0:2]
+        image = np.rot90(image, -self.k)
+        x1, y1, x2, y2 = boxes.astype(np.float32).T
+        if self.k == 1:
+            boxes = np.stack([height - y2, x1, height - y1, x2], axis=1)
+        elif self.k == 2:
+            boxes = np.stack(
+                [width - x2, height - y2, width - x1, height - y1], axis=1)
+        else:
+            boxes = np.stack([y1, width - x2, y2, width - x1], axis=1)
+
+        # like imgaug, only resize and project when the shape changed; a
+        # square image keeps its closed-form coordinates as they are
+        if self.k % 2 == 1 and height != width:
+            # squash the rotated image back to the original size, with the
+            # interpolation imgaug picks when a side grows
+            image = cv2.resize(
+                np.ascontiguousarray(image), (width, height),
+                interpolation=cv2.INTER_AREA)
+            # project in float32 in the same order as imgaug, so both
+            # engines write identical coordinates
+            rotated_size = np.array([height, width] * 2, dtype=np.float32)
+            boxes = boxes / rotated_size * rotated_size[[1, 0, 3, 2]]
+        return image, boxes
+
+
+class FastMultiply:
+    """
+    Brightness scaling by a factor drawn uniformly from [low, high], applied
+    as a lookup table
+    """
+    def __init__(self, low, high):
+        self.low = float(low)
+        self.high = float(high)
+        # only its parameters are used, to draw the same factors
+        self.augmenter = iaa.Multiply((self.low, self.high))
+
+    def __call__(self, image, boxes, seed=None):
+        if seed is None:
+            rng = ia.random.get_global_rng()
+        else:
+            # replays the draws iaa.Multiply makes once seeded with
+            # seed_(seed), so both engines agree for the same seed
+            rng = ia.random.RNG(seed)
+        channels = image.shape[2] if image.ndim == 3 else 1
+        rngs = rng.duplicate(2)
+        self.augmenter.per_channel.draw_samples((1,), random_state=rngs[0])
+        multiplier = np.float32(self.augmenter.mul.draw_samples(
+            (1, channels), random_state=rngs[1])[0, 0])
+        # same clipped table as iaa.Multiply uses for uint8 images
+        table = np.clip(
+            np.arange(0, 256, dtype=np.float32) * multiplier, 0, 255)
+        return cv2.LUT(
+            np.ascontiguousarray(image), table.astype(np.uint8)), boxes
+
+
+class FastGrayscale:
+    """
+    Grayscale conversion that keeps three channels
+    """
+    def __call__(self, image, boxes, seed=None):
+        # iaa.ChangeColorspace assumes RGB input, so convert the same way
+        gray = cv2.cvtColor(np.ascontiguousarray(image), cv2.COLOR_RGB2GRAY)
+        return cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR), boxes
+
+
+# Array implementations of the steps that are simple enough to skip imgaug.
+# Every other step falls back to its STEP_BUILDERS augmenter.
+FAST_STEP_BUILDERS = {
+    'rot90': FastRot90,
+    'multiply': FastMultiply,
+    'grayscale': FastGrayscale,
+}
+
+ENGINES = ('fast', 'imgaug')
+
+
+def build_step(step, engine='fast'):
+    """
+    Builds the callable for a single step, which takes and returns an image
+    and an (N, 4) array of boxes
+    :param step: tuple of the operation name and its arguments
+    :param engine: 'fast' to use the array implementation where there is
+        one, or 'imgaug' to always use imgaug
+    :return: the step callable
+    """
+    op, args = step[0], step[1:]
+    if op not in STEP_BUILDERS:
+        raise RuntimeError("Unknown augmentation step {}".format(op))
+    try:
+        if engine == 'fast' and op in FAST_STEP_BUILDERS:
+            return FAST_STEP_BUILDERS[op](*args)
+        return ImgaugStep(STEP_BUILDERS[op](*args))
+    except (TypeError, ValueError, AssertionError) as err:
+        raise RuntimeError(
+            "Invalid arguments for augmentation step {}: {}".format(
+                step, err))
+
+
+def _parse_number(value):
+    try:
+        number = float(value)
+    except ValueError:
+        raise RuntimeError(
+            "Invalid augmentation step argument {!r}".format(value))
+    return int(number) if number.is_integer() and '.' not in value \
+        else number
+
+
+def _parse_step(step):
+    """
+    Normalizes a step given as "op:arg:arg" or as a list [op, arg, arg]
+    """
+    if isinstance(step, str):
+        parts = step.strip().split(':')
+        return (parts[0],) + tuple(_parse_number(p) for p in parts[1:])
+    if isinstance(step, (list, tuple)) and step:
+        return tuple(step)
+    raise RuntimeError("Invalid augmentation step {!r}".format(step))
+
+
+def load_spec(spec):
+    """
+    Loads a declarative augmentation pipeline spec.
+
+    The spec is either a path to a JSON or YAML file, or an inline string
+    such as "darken;tilt=rot90:1+multiply:1.1:1.2". In a file, the top
+    level maps each augmentation name to its list of steps, or to an object
+    with "steps" and an optional "suffix". Steps are written "op:arg:arg"
+    or as a list [op, arg, arg]; a name without steps refers to one of the
+    predefined AUGMENTATIONS.
+    :param spec: path to a spec file, or an inline spec string
+    :return: ordered dictionary of name to (suffix, steps)
+    """
+    if os.path.isfile(spec):
+        with open(spec) as f:
+            if spec.endswith(('.yaml', '.yml')):
+                try:
+                    import yaml
+                except ImportError:
+                    raise RuntimeError(
+                        "PyYAML is required to read {}".format(spec))
+                document = yaml.safe_load(f)
+            else:
+                document = json.load(f)
+    else:
+        document = collections.OrderedDict()
+        for entry in spec.split(';'):
+            if not entry.strip():
+                continue
+            name, _, steps = entry.partition('=')
+            document[name.strip()] = steps.split('+') if steps else None
+
+    if not isinstance(document, dict):
+        raise RuntimeError("Augmentation spec must map names to steps")
+
+    augmentations = collections.OrderedDict()
+    for name, definition in document.items():
+        if not definition:
+            if name not in AUGMENTATIONS:
+                raise RuntimeError("Unknown augmentation {}".format(name))
+            augmentations[name] = AUGMENTATIONS[name]
+            continue
+        suffix = "_{}".format(name)
+        if isinstance(definition, dict):
+            suffix = definition.get('suffix', suffix)
+            definition = definition.get('steps', [])
+        steps = tuple(_parse_step(step) for step in definition)
+        # fail fast on bad operations or arguments, before any image is read
+        for step in steps:
+            build_step(step, engine='imgaug')
+        augmentations[name] = (suffix, steps)
+    return augmentations
+
+
+class AugmentationGraph:
+    """
+    Prefix tree of the selected augmentations. Each node applies one step to
+    the image and boxes of its parent, so an intermediate result such as the
+    darkened image is computed once per image and reused by every
+    augmentation that starts with it.
+    """
+    def __init__(self, augmentations, engine='fast'):
+        """
+        :param augmentations: iterable of (suffix, steps) pairs
+        :param engine: the step engine, see build_step
+        """
+        self.root = _GraphNode(None, ())
+        self.variant_count = 0
+        self.step_count = 0
+        # one augmenter object per distinct step, shared by every node
+        augmenters = {}
+        suffixes = set()
+        for suffix, steps in augmentations:
+            if suffix in suffixes:
+                raise RuntimeError(
+                    "Duplicate augmentation suffix {}".format(suffix))
+            suffixes.add(suffix)
+            node = self.root
+            for step in steps:
+                if step not in augmenters:
+                    augmenters[step] = build_step(step, engine)
+                if step not in node.children:
+                    node.children[step] = _GraphNode(
+                        augmenters[step], node.path + (step,))
+                    self.step_count += 1
+                node = node.children[step]
+            node.suffixes.append(suffix)
+            self.variant_count += 1
+
+    def run(self, image, boxes, seed=None, timings=None):
+        """
+        Generator over the augmented results for one image
+        :param image: the original image
+        :param boxes: the original boxes as an (N, 4) array of x1, y1, x2, y2
+        :param seed: optional seed of this image. Each step is seeded from
+            it and the chain of steps leading to it, so a step shared by
+            several augmentations draws the same parameters for all of them.
+        :param timings: optional dictionary, filled with the seconds taken
+            by each chain of steps
+        :return: yields (suffix, augmented image, augmented boxes)
+        """
+        yield from self._run(self.root, image, boxes, seed, timings)
+
+    def _run(self, node, image, boxes, seed, timings):
+        for suffix in node.suffixes:
+            yield suffix, image, boxes
+        for child in node.children.values():
+            start = time.perf_counter()
+            child_image, child_boxes = child.augmenter(
+                image, boxes,
+                None if seed is None else derive_seed(seed, child.path))
+            if timings is not None:
+                timings[child.path] = time.perf_counter() - start
+            yield from self._run(
+                child, child_image, child_boxes, seed, timings)
+
+
+class _GraphNode:
+    def __init__(self, augmenter, path):
+        self.augmenter = augmenter
+        self.path = path
+        self.children = collections.OrderedDict()
+        self.suffixes = []
+
+
+def read_boxes(root):
+    """
+    Reads the bounding boxes of an annotation in document order
+    :param root: the root element of the annotation
+    :return: (N, 4) float32 array of x1, y1, x2, y2
+    """
+    boxes = [
+        [float(box.find(tag).text)
+         for tag in ('xmin', 'ymin', 'xmax', 'ymax')]
+        for obj in root.findall('object')
+        for box in obj.findall('bndbox')]
+    return np.array(boxes, dtype=np.float32).reshape(-1, 4)
+
+
+class AnnotationTemplate:
+    """
+    An annotation serialized once, with slots for the image file name and
+    every box coordinate. Each augmented variant is rendered by filling the
+    slots, rather than by cloning and rewriting the parsed tree.
+    """
+    # never valid in XML 1.0, so it cannot clash with annotation content
+    _SLOT = '\x01'
+
+    def __init__(self, tree):
+        """
+        :param tree: the parsed annotation
+        """
+        root = tree.getroot()
+        slots = {}
+        filename = root.find('filename')
+        if filename is not None:
+            slots[filename] = None
+        count = 0
+        for obj in root.findall('object'):
+            for box in obj.findall('bndbox'):
+                for column, tag in enumerate(('xmin', 'ymin', 'xmax', 'ymax')):
+                    slots[box.find(tag)] = (count, column)
+                count += 1
+        self.box_count = count
+
+        # serialize with a marker in every slot, remembering the slots in
+        # document order, then put the original text back
+        self.slots = []
+        original_text = {}
+        for element in root.iter():
+            if element in slots:
+                self.slots.append(slots[element])
+                original_text[element] = element.text
+                element.text = self._SLOT
+        try:
+            document = ET.tostring(root, encoding='unicode')
+        finally:
+            for element, text in original_text.items():
+                element.text = text
+        self.chunks = [
+            chunk.encode('us-ascii', 'xmlcharrefreplace')
+            for chunk in document.split(self._SLOT)]
+
+    def render(self, image_name, boxes):
+        """
+        Renders the annotation of one augmented image
+        :param image_name: file name of the augmented image
+        :param boxes: (N, 4) array of x1, y1, x2, y2 in annotation order
+        :return: the annotation as bytes, as ElementTree would write it
+        """
+        if len(boxes) != self.box_count:
+            raise RuntimeError("Expected {} boxes, got {}".format(
+                self.box_count, len(boxes)))
+        image_name = escape(image_name).encode('us-ascii', 'xmlcharrefreplace')
+        # str() of the float32 values, as the coordinates were always written
+        coordinates = [
+            str(value).encode('us-ascii') for value in boxes.ravel()]
+        parts = [self.chunks[0]]
+        for slot, chunk in zip(self.slots, self.chunks[1:]):
+            if slot is None:
+                parts.append(image_name)
+            else:
+                parts.append(coordinates[slot[0] * 4 + slot[1]])
+            parts.append(chunk)
+        return b''.join(parts)
+
+
+IMAGE_FORMATS = ('jpg', 'webp', 'png')
+
+
+class ImageCodec:
+    """
+    How augmented images are encoded. Options left as None keep the
+    OpenCV defaults, and an image format of None keeps the source format.
+    """
+    def __init__(
+            self, image_format=None, jpeg_quality=None, jpeg_optimize=False,
+            jpeg_progressive=False, webp_quality=None, png_compression=None):
+        if image_format is not None and image_format not in IMAGE_FORMATS:
+            raise RuntimeError("Unknown image format {}".format(image_format))
+        self.image_format = image_format
+        self.jpeg_quality = jpeg_quality
+        self.jpeg_optimize = jpeg_optimize
+        self.jpeg_progressive = jpeg_progressive
+        self.webp_quality = webp_quality
+        self.png_compression = png_compression
+
+    def suffix(self, source_suffix):
+        """
+        :param source_suffix: extension of the source image, with the dot
+        :return: extension of the augmented image, with the dot
+        """
+        if self.image_format is None:
+            return source_suffix
+        return ".{}".format(self.image_format)
+
+    def params(self, suffix):
+        """
+        :param suffix: extension of the image to encode, with the dot
+        :return: the cv2.imencode parameters for that format
+        """
+        suffix = suffix.lower()
+        params = []
+        if suffix in ('.jpg', '.jpeg'):
+            if self.jpeg_quality is not None:
+                params += [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality]
+            if self.jpeg_optimize:
+                params += [cv2.IMWRITE_JPEG_OPTIMIZE, 1]
+            if self.jpeg_progressive:
+                params += [cv2.IMWRITE_JPEG_PROGRESSIVE, 1]
+        elif suffix == '.webp':
+            if self.webp_quality is not None:
+                params += [cv2.IMWRITE_WEBP_QUALITY, self.webp_quality]
+        elif suffix == '.png':
+            if self.png_compression is not None:
+                params += [cv2.IMWRITE_PNG_COMPRESSION, self.png_compression]
+        return params
+
+    def encode(self, image_name, image):
+        """
+        :return: the encoded image as bytes
+        """
+        suffix = os.path.splitext(image_name)[1]
+        ok, data = cv2.imencode(suffix, image, self.params(suffix))
+        if not ok:
+            raise RuntimeError("Could not encode {}".format(image_name))
+        return data.tobytes()
+
+    def describe(self):
+        """
+        :return: dictionary of the options, for fingerprinting the output
+        """
+        return dict(vars(self))
+
+
+class EncoderPool:
+    """
+    Runs image encoding and writing on background threads, so they overlap
+    with augmenting the next variant; OpenCV releases the GIL while
+    encoding. At most max_pending images wait to be written, which bounds
+    the memory held by decoded images. With no threads, every job runs
+    immediately in the calling thread.
+    """
+    def __init__(self, threads, max_pending=None):
+        self.executor = ThreadPoolExecutor(threads) if threads > 0 else None
+        self.slots = threading.BoundedSemaphore(
+            max_pending or 2 * max(threads, 1))
+
+    def submit(self, fn, *args):
+        """
+        :return: a Future of the job's result
+        """
+        if self.executor is None:
+            future = Future()
+            try:
+                future.set_result(fn(*args))
+            except Exception as err:
+                future.set_exception(err)
+            return future
+
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(fn, *args)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+
+class DirectoryWriter:
+    """
+    Writes augmented images and annotations into an extracted dataset folder
+    """
+    def __init__(self, output_dir, codec, encoder):
+        self.image_dir = os.path.join(output_dir, IMAGE_DIR)
+        self.annotation_dir = os.path.join(output_dir, ANNOTATION_DIR)
+        self.codec = codec
+        self.encoder = encoder
+
+    def write_image(self, image_name, image):
+        """
+        Encodes and writes an image in the background
+        :return: a Future of the encoding and writing seconds, which
+            completes once the image is written
+        """
+        return self.encoder.submit(self._write_image, image_name, image)
+
+    def _write_image(self, image_name, image):
+        start = time.perf_counter()
+        data = self.codec.encode(image_name, image)
+        encoded = time.perf_counter()
+        with open(os.path.join(self.image_dir, image_name), 'wb') as f:
+            f.write(data)
+        return encoded - start, time.perf_counter() - encoded
+
+    def write_annotation(self, annotation_name, data):
+        annotation_path = os.path.join(self.annotation_dir, annotation_name)
+        with open(annotation_path, 'wb') as f:
+            f.write(data)
+
+
+class ZipWriter:
+    """
+    Writes augmented images and annotations straight into an open zip file
+    """
+    def __init__(self, target, codec, encoder):
+        self.target = target
+        self.codec = codec
+        self.encoder = encoder
+        # members are appended one at a time, whichever thread writes them
+        self.lock = threading.Lock()
+
+    def write_image(self, image_name, image):
+        """
+        Encodes and writes an image in the background
+        :return: a Future of the encoding and writing seconds, which
+            completes once the image is written
+        """
+        return self.encoder.submit(self._write_image, image_name, image)
+
+    def _write_image(self, image_name, image):
+        start = time.perf_counter()
+        data = self.codec.encode(image_name, image)
+        encoded = time.perf_counter()
+        with self.lock:
+            write_member(
+                self.target, posixpath.join(IMAGE_DIR, image_name), data)
+        return encoded - start, time.perf_counter() - encoded
+
+    def write_annotation(self, annotation_name, data):
+        with self.lock:
+            write_member(
+                self.target,
+                posixpath.join(ANNOTATION_DIR, annotation_name), data)
+
+
+class Manifest:
+    """
+    Append-only JSON lines record of the augmented outputs written for each
+    source annotation, keyed by the content of its annotation and image,
+    the augmentation spec and the seed. A resumed run skips every source
+    whose record still matches and whose outputs still exist.
+    """
+    def __init__(self, path, resume):
+        """
+        :param path: path of the manifest file
+        :param resume: keep the records of a previous run
+        """
+        self.path = path
+        self.entries = {}
+        if not resume:
+            open(self.path, 'w').close()
+            return
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # torn last line of a run that died mid-write
+                        continue
+                    self.entries[entry['source']] = entry
+
+    def record(self, entry):
+        # one small append per entry, so records from concurrent worker
+        # processes never interleave
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry) + "\n")
+
+    def compact(self, sources):
+        """
+        Rewrites the manifest with only the latest record of each source
+        :param sources: the sources still in the input
+        """
+        entries = Manifest(self.path, resume=True).entries
+        temp_path = "{}.tmp".format(self.path)
+        with open(temp_path, 'w') as f:
+            for source in sources:
+                if source in entries:
+                    f.write(json.dumps(entries[source]) + "\n")
+        os.replace(temp_path, self.path)
+
+
+def _step_key(path):
+    """
+    Names a chain of steps in the inline spec syntax, e.g. "rot90:1+blur:2"
+    """
+    return "+".join(":".join(str(part) for part in step) for step in path)
+
+
+class RunReport:
+    """
+    Timings of an augmentation run: the seconds and count of every stage,
+    of every augmentation step and of every augmented variant, plus the
+    seconds each image took. Worker processes fill their own report, which
+    is merged into the parent's.
+    """
+    PERCENTILES = (50, 90, 99)
+
+    def __init__(self):
+        # name to [seconds, count]
+        self.stages = {}
+        # chain of steps to [seconds, count]
+        self.steps = {}
+        # variant suffix to stage name to [seconds, count]
+        self.variants = {}
+        # one (source, width, height, stages) tuple per augmented image
+        self.images = []
+
+    @staticmethod
+    def _add(totals, key, seconds, count=1):
+        total = totals.setdefault(key, [0.0, 0])
+        total[0] += seconds
+        total[1] += count
+
+    def add(self, stage, seconds, count=1):
+        self._add(self.stages, stage, seconds, count)
+
+    def add_step(self, path, seconds):
+        self._add(self.steps, path, seconds)
+
+    def add_variant(self, suffix, stage, seconds):
+        self._add(self.variants.setdefault(suffix, {}), stage, seconds)
+
+    def add_image(self, source, image_shape, stages):
+        self.images.append(
+            (source, image_shape[1], image_shape[0], dict(stages)))
+
+    def merge(self, other):
+        for stage, (seconds, count) in other.stages.items():
+            self._add(self.stages, stage, seconds, count)
+        for path, (seconds, count) in other.steps.items():
+            self._add(self.steps, path, seconds, count)
+        for suffix, stages in other.variants.items():
+            for stage, (seconds, count) in stages.items():
+                self._add(
+                    self.variants.setdefault(suffix, {}), stage, seconds,
+                    count)
+        self.images.extend(other.images)
+
+    def to_dict(self, augmentations, wall_seconds, slowest=10):
+        """
+        :param augmentations: ordered dictionary of the augmentation names
+            to (suffix, steps)
+        :param wall_seconds: the duration of the whole run
+        :param slowest: the number of slowest images to list
+        :return: JSON serializable summary of the run
+        """
+        def totals(seconds_count):
+            return {'seconds': seconds_count[0], 'count': seconds_count[1]}
+
+        variants = collections.OrderedDict()
+        for name, (suffix, steps) in augmentations.items():
+            # a shared step counts towards every variant that uses it
+            chains = [tuple(steps[:end]) for end in range(1, len(steps) + 1)]
+            variant = {'augment_seconds': sum(
+                self.steps.get(chain, [0.0])[0] for chain in chains)}
+            for stage, seconds_count in self.variants.get(suffix, {}).items():
+                variant['{}_seconds'.format(stage)] = seconds_count[0]
+            variants[name] = variant
+
+        image_seconds = np.array(
+            [sum(stages.values()) for _, _, _, stages in self.images])
+        per_image = None
+        if len(image_seconds):
+            per_image = {
+                'p{}'.format(q): float(np.percentile(image_seconds, q))
+                for q in self.PERCENTILES}
+            per_image['mean'] = float(image_seconds.mean())
+            per_image['max'] = float(image_seconds.max())
+
+        order = np.argsort(-image_seconds, kind='stable')[:slowest]
+        return {
+            'wall_seconds': wall_seconds,
+            'images': len(self.images),
+            'images_per_sec':
+                len(self.images) / wall_seconds if wall_seconds else None,
+            'stages': {
+                stage: totals(seconds_count)
+                for stage, seconds_count in sorted(self.stages.items())},
+            'steps': {
+                _step_key(path): totals(seconds_count)
+                for path, seconds_count in self.steps.items()},
+            'variants': variants,
+            'per_image_seconds': per_image,
+            'slowest': [
+                {
+                    'source': self.images[index][0],
+                    'width': self.images[index][1],
+                    'height': self.images[index][2],
+                    'seconds': float(image_seconds[index]),
+                    'stages': self.images[index][3],
+                }
+                for index in order],
+        }
+
+
+def content_key(infos, annotation_member, image_member):
+    """
+    Fingerprints an annotation and its image from the CRC-32 and size
+    stored in the zip's central directory, without reading either member
+    :param infos: dictionary of member name to zipfile.ZipInfo
+    :return: hex digest, or None if a member is missing
+    """
+    if annotation_member not in infos or image_member not in infos:
+        return None
+    digest = hashlib.sha1()
+    for member in (annotation_member, image_member):
+        info = infos[member]
+        digest.update("{}:{:08x}:{};".format(
+            member, info.CRC, info.file_size).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def spec_key(augmentations, codec_options, engine='fast'):
+    """
+    Fingerprints the selected augmentations, the engine running them and how
+    their images are encoded
+    :param augmentations: iterable of (suffix, steps) pairs
+    :param codec_options: dictionary of the ImageCodec options
+    :param engine: the engine the steps run with, see ENGINES
+    :return: hex digest
+    """
+    return hashlib.sha1(json.dumps(
+        [sorted(augmentations), codec_options, engine],
+        sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _init_worker():
+    """
+    Reseeds imgaug in each worker process, otherwise every forked worker
+    would draw the same random augmentation parameters
+    """
+    ia.seed(int.from_bytes(os.urandom(4), "little"))
+
+
 class Augmenter:
     def __init__(self, input_dir):
         self.input_dir = input_dir
         self.original_input_dir_name = None
         self.output_dir = None
 
-    def get_updated_annotation(self, input_annotation, bounding_boxes):
+    def _time(self, stage, start):
         """
-        Function to update the annotation's bounding boxes
-        :param input_annotation: the original annotation read in
-        :param bounding_boxes: the augmented bounding boxes
-        :return: the updated annotation in xml format
+        Adds the seconds since start to a stage of the run and of the
+        current image
         """
-        annotation = cp.deepcopy(input_annotation)
-        count = 0
-        root = annotation.getroot()
-
-        for obj in root.findall('object'):
-            for box in obj.findall('bndbox'):
-                box.find('xmin').text = str(bounding_boxes[count].x1)
-                box.find('xmax').text = str(bounding_boxes[count].x2)
-                box.find('ymin').text = str(bounding_boxes[count].y1)
-                box.find('ymax').text = str(bounding_boxes[count].y2)
-                count += 1
-        return annotation
+        seconds = time.perf_counter() - start
+        self.report.add(stage, seconds)
+        self.image_stages[stage] = self.image_stages.get(stage, 0.0) + seconds
+        return seconds
 
     def write_augmented_files(
             self, aug_bbs, aug_image, aug_str, annotation_file):
-        aug_image_path = "{}{}".format(
-            os.path.join(
-                self.image_path, self.i + aug_str), self.i_suffix)
-
-        cv2.imwrite(aug_image_path, aug_image)
-        aug_annotation = self.get_updated_annotation(self.tree, aug_bbs)
-        aug_annotation.find('filename').text = "{}{}{}".format(
-            self.i, aug_str, self.i_suffix)
-        aug_annotation.write(
-            os.path.join(
-                self.new_annotation_path, annotation_file.replace(
-                    ".xml", "{}.xml".format(aug_str))))
+        aug_image_name = "{}{}{}".format(
+            self.i, aug_str, self.codec.suffix(self.i_suffix))
+        aug_annotation_name = annotation_file.replace(
+            ".xml", "{}.xml".format(aug_str))
+        # only waits when the encoder threads are behind
+        start = time.perf_counter()
+        self.image_writes.append((
+            aug_str, self.writer.write_image(aug_image_name, aug_image)))
+        self._time('encoder_wait', start)
+        start = time.perf_counter()
+        self.writer.write_annotation(
+            aug_annotation_name,
+            self.template.render(aug_image_name, aug_bbs))
+        self.report.add_variant(
+            aug_str, 'annotation', self._time('annotation', start))
+        self.outputs.append(posixpath.join(IMAGE_DIR, aug_image_name))
+        self.outputs.append(
+            posixpath.join(ANNOTATION_DIR, aug_annotation_name))
+
+    def augment_file(self, annotation_file):
+        """
+        Runs the full per-image pipeline for a single annotation file. The
+        original image and annotation are already in the extracted output
+        directory and are left untouched.
+        :param annotation_file: path of the annotation file to augment
+        """
+        # nothing to augment, so don't decode anything
+        if not self.graph.variant_count:
+            return
+
+        # read in the annotation for the image
+        self.image_stages = {}
+        start = time.perf_counter()
+        tree = ET.parse(annotation_file)
+        self._time('parse', start)
+
+        # make the new image path and name
+        image_name = tree.getroot().find('filename').text
+        original_image_path = os.path.join(
+            self.output_dir, IMAGE_DIR, image_name)
+        start = time.perf_counter()
+        image = cv2.imread(original_image_path)
+        self._time('read', start)
+        if image is None:
+            raise RuntimeError("Invalid image path {}".format(
+                original_image_path))
+
+        annotation_member = os.path.relpath(
+            annotation_file, self.output_dir).replace(os.sep, '/')
+        self._augment_loaded(
+            tree, image, annotation_member,
+            image_member(annotation_member, image_name))
+
+    def augment_member(self, annotation_member):
+        """
+        Runs the per-image pipeline for an annotation member of the input
+        zip, writing the augmented files into the output zip. The originals
+        are passed through separately as raw zip members.
+        :param annotation_member: name of the annotation member to augment
+        """
+        if not self.graph.variant_count:
+            return
+
+        self.image_stages = {}
+        start = time.perf_counter()
+        tree = ET.ElementTree(
+            ET.fromstring(self.source.read(annotation_member)))
+        self._time('parse', start)
+
+        image_name = tree.getroot().find('filename').text
+        member = image_member(annotation_member, image_name)
+        if member not in self.source.NameToInfo:
+            raise RuntimeError("Missing image member {}".format(member))
+        start = time.perf_counter()
+        image = cv2.imdecode(
+            np.frombuffer(self.source.read(member), np.uint8),
+            cv2.IMREAD_COLOR)
+        self._time('read', start)
+        if image is None:
+            raise RuntimeError("Invalid image member {}".format(member))
+
+        self._augment_loaded(tree, image, annotation_member, member)
+
+    def _augment_loaded(self, tree, image, annotation_member, image_member):
+        """
+        Augments an image whose annotation and pixels are already loaded,
+        and records its outputs in the manifest
+        :param tree: the parsed annotation
+        :param image: the decoded image
+        :param annotation_member: zip member name of the annotation
+        :param image_member: zip member name of the image
+        """
+        self.outputs = []
+        self.image_writes = []
+        self.template = AnnotationTemplate(tree)
+        root = tree.getroot()
+
+        image_name = root.find('filename').text
+        image_suffix_ind = image_name.rfind(".")
+        self.i = image_name[:image_suffix_ind]
+        self.i_suffix = image_name[image_suffix_ind:]
+
+        # Now augment the images and update the bounding boxes
+        # all the bounding boxes
+        boxes = read_boxes(root)
+
+        # run every selected augmentation, sharing intermediate results
+        annotation_name = posixpath.basename(annotation_member)
+        image_seed = None if self.seed is None \
+            else derive_seed(self.seed, annotation_member)
+        timings = {}
+        for aug_str, aug_image, aug_bbs in self.graph.run(
+                image, boxes, image_seed, timings):
+            self.write_augmented_files(
+                aug_bbs, aug_image, aug_str, annotation_name)
+        for path, seconds in timings.items():
+            self.report.add_step(path, seconds)
+        self.report.add('augment', sum(timings.values()))
+        self.image_stages['augment'] = sum(timings.values())
+
+        # only record the file once its images are actually written
+        self.pending_records.append(({
+            'source': annotation_member,
+            'image': image_member,
+            'content': content_key(
+                self.input_infos, annotation_member, image_member),
+            'spec': self.spec_key,
+            'seed': self.seed,
+            'outputs': self.outputs,
+        }, self.image_writes, self.image_stages, image.shape))
+        self._flush_records(block=False)
+
+    def _open_writer(self, target=None):
+        """
+        Starts writing augmented files, each writer with its own encoder
+        threads
+        :param target: the zipfile.ZipFile to write to, or None to write
+            into the extracted output directory
+        """
+        encoder = EncoderPool(self.encoder_threads)
+        if target is None:
+            self.writer = DirectoryWriter(self.output_dir, self.codec, encoder)
+        else:
+            self.writer = ZipWriter(target, self.codec, encoder)
+        self.pending_records = []
+        self.write_errors = []
+
+    def _flush_records(self, block):
+        """
+        Records in the manifest the augmented files whose images are all
+        written. Files with a failed write are not recorded, so a resumed
+        run augments them again.
+        :param block: wait for the outstanding writes instead of skipping
+            the files that are still being written
+        """
+        still_pending = []
+        for record in self.pending_records:
+            entry, writes, stages, image_shape = record
+            futures = [future for _, future in writes]
+            if block:
+                wait(futures)
+            elif not all(future.done() for future in futures):
+                still_pending.append(record)
+                continue
+            errors = [
+                future.exception() for future in futures
+                if future.exception() is not None]
+            if errors:
+                self.write_errors.append((entry['source'], repr(errors[0])))
+                continue
+
+            start = time.perf_counter()
+            self.manifest.record(entry)
+            self.report.add('manifest', time.perf_counter() - start)
+            for suffix, future in writes:
+                encode_seconds, write_seconds = future.result()
+                self.report.add('encode', encode_seconds)
+                self.report.add('write_image', write_seconds)
+                self.report.add_variant(suffix, 'encode', encode_seconds)
+                self.report.add_variant(suffix, 'write', write_seconds)
+                stages['encode'] = stages.get('encode', 0.0) + encode_seconds
+                stages['write_image'] = \
+                    stages.get('write_image', 0.0) + write_seconds
+            self.report.add_image(entry['source'], image_shape, stages)
+        self.pending_records = still_pending
+
+    def _close_writer(self):
+        """
+        Waits for every outstanding write and stops the encoder threads
+        :return: list of (annotation member, error message) pairs for the
+            files whose images failed to write
+        """
+        self._flush_records(block=True)
+        self.writer.encoder.close()
+        self.writer = None
+        return self.write_errors
+
+    def _augment_serial(self, annotation_files, augment, target=None):
+        """
+        Augments the annotation files one after the other in this process
+        :param augment: augment_file or augment_member
+        :param target: the zipfile.ZipFile to write to when streaming
+        """
+        self._open_writer(target)
+        try:
+            for annotation_file in annotation_files:
+                print(annotation_file)
+                augment(annotation_file)
+        finally:
+            errors = self._close_writer()
+        if errors:
+            for annotation_file, err in errors:
+                print("\t{}: {}".format(annotation_file, err))
+            raise RuntimeError(
+                "{} annotation files failed to write.".format(len(errors)))
+
+    def _augment_shard(self, job):
+        """
+        Augments one shard of annotation files inside a worker process
+        :param job: tuple of shard index, shard count, annotation files and
+            the path of the zip to write the shard to when streaming
+        :return: the shard index, the number of files augmented, a list of
+            (annotation file, error message) pairs for failed files and the
+            RunReport of the shard
+        """
+        shard_id, shard_count, shard, part_path = job
+        if part_path is None:
+            self._open_writer()
+            return self._run_shard(
+                shard_id, shard_count, shard, self.augment_file)
+
+        with zipfile.ZipFile(self.input_dir, 'r') as source, \
+                zipfile.ZipFile(part_path, 'w') as target:
+            self.source = source
+            self._open_writer(target)
+            return self._run_shard(
+                shard_id, shard_count, shard, self.augment_member)
+
+    def _run_shard(self, shard_id, shard_count, shard, augment):
+        # a fresh report, so the parent's stages are not merged back twice
+        self.report = RunReport()
+        done = 0
+        errors = []
+        for count, annotation_file in enumerate(shard, 1):
+            try:
+                augment(annotation_file)
+                done += 1
+            except Exception as err:
+                # keep going so the whole shard is reported, not just the
+                # first failure
+                errors.append((annotation_file, repr(err)))
+            if count % 100 == 0 or count == len(shard):
+                print("Shard {}/{}: {}/{} files".format(
+                    shard_id + 1, shard_count, count, len(shard)))
+
+        # images still being encoded can fail after their file was counted
+        write_errors = self._close_writer()
+        errors.extend(write_errors)
+        return shard_id, done - len(write_errors), errors, self.report
+
+    def _augment_parallel(self, annotation_files, workers, stream=False):
+        """
+        Shards the annotation files across a pool of worker processes, each
+        running the full per-image pipeline on its own shard
+        :param annotation_files: the annotation files to augment
+        :param workers: the number of worker processes
+        :param stream: write each shard to its own zip instead of the
+            extracted output directory
+        :return: the shard zip paths in shard order, when streaming
+        """
+        shard_size = max(1, int(math.ceil(
+            len(annotation_files) / float(workers))))
+        shards = [
+            annotation_files[i:i + shard_size]
+            for i in range(0, len(annotation_files), shard_size)]
+        part_paths = [
+            "{}.part{}.zip".format(self.output_dir, shard_id)
+            if stream else None
+            for shard_id in range(len(shards))]
+        jobs = [
+            (shard_id, len(shards), shard, part_paths[shard_id])
+            for shard_id, shard in enumerate(shards)]
+
+        failed = []
+        with multiprocessing.Pool(
+                len(shards) or 1, initializer=_init_worker) as pool:
+            for shard_id, done, errors, report in pool.imap_unordered(
+                    self._augment_shard, jobs):
+                self.report.merge(report)
+                print("Shard {}/{} finished: {} augmented, {} failed.".format(
+                    shard_id + 1, len(shards), done, len(errors)))
+                for annotation_file, err in errors:
+                    print("\t{}: {}".format(annotation_file, err))
+                failed.extend(errors)
+
+        if failed:
+            raise RuntimeError(
+                "{} annotation files failed to augment.".format(len(failed)))
+        return part_paths
+
+    def _open_previous_output(self):
+        """
+        Opens the zip written by a previous complete run, if there is one
+        :return: the zipfile.ZipFile, or None
+        """
+        previous_zip = "{}.zip".format(self.output_dir)
+        if zipfile.is_zipfile(previous_zip):
+            return zipfile.ZipFile(previous_zip, 'r')
+        return None
+
+    def _recover_interrupted_outputs(self):
+        """
+        Makes the zips a streaming run was writing when it died readable
+        again: its partial output and the zips of its worker shards, whose
+        written members the manifest already records. Each is renamed, so
+        this run's own zips don't overwrite it, and kept until this run
+        completes.
+        :return: the paths of the recovered zips, newest first
+        """
+        prefix = glob.escape(self.output_dir)
+        recovered = sorted(glob.glob(prefix + '.recovered*.zip'))
+        interrupted = [
+            "{}.partial.zip".format(self.output_dir)] + sorted(
+                glob.glob(prefix + '.part[0-9]*.zip'))
+        for path in interrupted:
+            if not os.path.exists(path):
+                continue
+            if not zipfile.is_zipfile(path):
+                print("Recovered {} members of interrupted output {}.".format(
+                    recover_zip(path), path))
+            recovered_path = "{}.recovered{}.zip".format(
+                self.output_dir, len(recovered))
+            os.replace(path, recovered_path)
+            recovered.append(recovered_path)
+        return recovered[::-1]
+
+    def _plan_resume(self, annotation_members, is_available):
+        """
+        Splits the annotation members into the ones whose manifest record
+        still matches the input, spec and seed, and the ones to augment
+        :param annotation_members: the annotation members of the input
+        :param is_available: callable telling whether an output member of a
+            previous run can still be used
+        :return: list of members to augment, and dictionary of the reused
+            members to their manifest record
+        """
+        pending = []
+        reused = {}
+        for member in annotation_members:
+            entry = self.manifest.entries.get(member)
+            if entry is not None and \
+                    entry['spec'] == self.spec_key and \
+                    entry['seed'] == self.seed and \
+                    entry['content'] is not None and \
+                    entry['content'] == content_key(
+                        self.input_infos, member, entry['image']) and \
+                    all(is_available(name) for name in entry['outputs']):
+                reused[member] = entry
+            else:
+                pending.append(member)
+        print("Resuming: {} of {} annotation files already augmented.".format(
+            len(reused), len(annotation_members)))
+        return pending, reused
+
+    def _augment_stream(self, workers, resume):
+        """
+        Streams the input zip into the output zip. The input members are
+        copied through as raw compressed data, and only the augmented images
+        and annotations are encoded and written. The zip is written under a
+        temporary name and only renamed once complete.
+        :param workers: the number of worker processes
+        :param resume: reuse the outputs still valid according to the
+            manifest, from the zips of a run that died part-way or of the
+            last complete run
+        """
+        output_zip = "{}.zip".format(self.output_dir)
+        partial_zip = "{}.partial.zip".format(self.output_dir)
+        recovered = self._recover_interrupted_outputs() if resume else []
+        # the outputs of a run that died part-way come first, as they are
+        # newer than the last complete run's
+        previous = [zipfile.ZipFile(path, 'r') for path in recovered]
+        complete = self._open_previous_output() if resume else None
+        if complete is not None:
+            previous.append(complete)
+
+        def find_output(name):
+            for outputs in previous:
+                if name in outputs.NameToInfo:
+                    return outputs
+            return None
+
+        print("Streaming {} to {}...".format(self.input_dir, output_zip))
+        with zipfile.ZipFile(self.input_dir, 'r') as source, \
+                zipfile.ZipFile(partial_zip, 'w') as target:
+            annotation_members = [
+                info.filename for info in source.infolist()
+                if is_annotation_member(info.filename)]
+
+            # pass the original dataset through untouched
+            start = time.perf_counter()
+            for info in source.infolist():
+                copy_raw_member(source, target, info)
+            self.report.add('copy', time.perf_counter() - start)
+
+            pending = annotation_members
+            if resume and self.graph.variant_count:
+                start = time.perf_counter()
+                pending, reused = self._plan_resume(
+                    annotation_members,
+                    lambda name: find_output(name) is not None)
+                for entry in reused.values():
+                    for name in entry['outputs']:
+                        outputs = find_output(name)
+                        copy_raw_member(
+                            outputs, target, outputs.getinfo(name))
+                self.report.add('resume', time.perf_counter() - start)
+
+            if not self.graph.variant_count:
+                print("No augmentations selected, dataset copied as is.")
+            elif workers > 1:
+                print("Augmenting images...")
+                part_paths = self._augment_parallel(
+                    pending, workers, stream=True)
+                start = time.perf_counter()
+                for part_path in part_paths:
+                    merge_zip(part_path, target)
+                    os.remove(part_path)
+                self.report.add('merge', time.perf_counter() - start)
+            else:
+                print("Augmenting images...")
+                self.source = source
+                try:
+                    self._augment_serial(pending, self.augment_member, target)
+                finally:
+                    self.source = None
+
+        for outputs in previous:
+            outputs.close()
+        os.replace(partial_zip, output_zip)
+        for path in recovered:
+            os.remove(path)
+        self.manifest.compact(annotation_members)
+
+    def _resume_directory(self, annotation_files, annotation_members):
+        """
+        Prepares the extracted output directory for a resumed run. Outputs
+        still valid are kept, or restored from the previous output zip, and
+        outdated outputs are removed.
+        :param annotation_files: paths of the extracted annotation files
+        :param annotation_members: the matching annotation member names
+        :return: the annotation files that still need augmenting
+        """
+        previous = self._open_previous_output()
+
+        def is_available(name):
+            return os.path.exists(os.path.join(self.output_dir, name)) or \
+                (previous is not None and name in previous.NameToInfo)
+
+        pending, reused = self._plan_resume(annotation_members, is_available)
+        for member, entry in self.manifest.entries.items():
+            for name in entry['outputs']:
+                path = os.path.join(self.output_dir, name)
+                if member not in reused:
+                    if os.path.exists(path):
+                        os.remove(path)
+                elif not os.path.exists(path):
+                    previous.extract(name, self.output_dir)
+        if previous is not None:
+            previous.close()
+
+        pending = set(pending)
+        return [
+            path for path, member in zip(annotation_files, annotation_members)
+            if member in pending]
+
+    def _write_report(self, path, augmentations, wall_seconds):
+        """
+        Prints where the time of the run went, and writes the full report
+        :param path: path of the JSON report, or None to only print
+        """
+        summary = self.report.to_dict(augmentations, wall_seconds)
+        print("{:.1f}s, {} images augmented".format(
+            wall_seconds, summary['images']))
+        for stage, totals in sorted(
+                summary['stages'].items(),
+                key=lambda item: -item[1]['seconds']):
+            print("\t{}: {:.2f}s".format(stage, totals['seconds']))
+        if summary['slowest']:
+            slowest = summary['slowest'][0]
+            print("\tslowest: {} ({}x{}, {:.2f}s)".format(
+                slowest['source'], slowest['width'], slowest['height'],
+                slowest['seconds']))
+        if path is not None:
+            with open(path, 'w') as f:
+                json.dump(summary, f, indent=2)
+            print("Report written to {}".format(path))
 
     def augment_images(
-        self, aug_all, rotate_180, darken, rotate_90_darken,
-            rotate_180_darken, brighten,
-            rotate_brighten, blur, rotate_180_blur,
-            rotate_270_darken, grayscale, rotate_90_grayscale,
-            rotate_180_grayscale, grayscale_darken, grayscale_brighten,
-            grayscale_blur, rotate_270_grayscale, zoom):
+        self, aug_all=False, rotate_180=False, darken=False,
+            rotate_90_darken=False, rotate_180_darken=False, brighten=False,
+            rotate_brighten=False, blur=False, rotate_180_blur=False,
+            rotate_270_darken=False, grayscale=False,
+            rotate_90_grayscale=False, rotate_180_grayscale=False,
+            grayscale_darken=False, grayscale_brighten=False,
+            grayscale_blur=False, rotate_270_grayscale=False, zoom=False,
+            workers=1, stream=False, specs=None, engine='fast',
+            output_dir=None, resume=False, codec=None, encoder_threads=2,
+            seed=None, report=None):
+        """
+        Augments the zipped dataset and writes the augmented zip. Every
+        boolean flag other than aug_all selects the predefined augmentation
+        of the same name.
+        :param aug_all: run every predefined augmentation
+        :param workers: the number of worker processes
+        :param stream: stream the input zip into the output zip
+        :param specs: additional augmentations, as returned by load_spec
+        :param engine: 'fast' to run rotations, brightness and grayscale as
+            plain array operations, or 'imgaug' to run every step in imgaug
+        :param output_dir: name of the output, without the .zip extension;
+            a timestamped name is generated if not given
+        :param resume: continue a partially written output, or update a
+            previous output, only augmenting new or changed images
+        :param codec: ImageCodec for the augmented images; the source
+            format with OpenCV's default settings if not given
+        :param encoder_threads: threads encoding and writing images per
+            process; 0 encodes in the augmenting thread
+        :param seed: base seed making the output reproducible, whatever the
+            number of workers; random if not given
+        :param report: optional path of a JSON file to write the timings of
+            the run to
+        """
+        run_start = time.perf_counter()
+        self.report = RunReport()
         # Check for invalid input directory
         if not os.path.exists(self.input_dir):
             input_dir = os.path.join(os.getcwd(), self.input_dir)
@@ -84,297 +1387,118 @@ class Augmenter:
 
         input_suffix_ind = self.input_dir.rfind(".")
         self.original_input_dir_name = self.input_dir[:input_suffix_ind]
-        self.output_dir = "{}-{}_augmented_{}".format(
-            res_date, res_time, self.input_dir[:input_suffix_ind], )
+        if output_dir is not None:
+            self.output_dir = output_dir
+        elif resume:
+            raise RuntimeError("Resuming requires an output directory.")
+        else:
+            self.output_dir = "{}-{}_augmented_{}".format(
+                res_date, res_time, self.input_dir[:input_suffix_ind], )
 
         # Check for existing output directory
-        if os.path.exists(os.path.join(os.getcwd(), self.output_dir)) or \
-                os.path.exists(
-                    os.path.join(os.getcwd(), self.output_dir, ".zip")):
+        if not resume and (
+                os.path.exists(os.path.join(os.getcwd(), self.output_dir)) or
+                os.path.exists(os.path.join(
+                    os.getcwd(), "{}.zip".format(self.output_dir)))):
             raise RuntimeError("Output directory already exists.")
 
+        selected = {
+            'rotate_180': rotate_180,
+            'darken': darken,
+            'rotate_90_darken': rotate_90_darken,
+            'rotate_180_darken': rotate_180_darken,
+            'brighten': brighten,
+            'rotate_brighten': rotate_brighten,
+            'blur': blur,
+            'rotate_180_blur': rotate_180_blur,
+            'rotate_270_darken': rotate_270_darken,
+            'grayscale': grayscale,
+            'rotate_90_grayscale': rotate_90_grayscale,
+            'rotate_180_grayscale': rotate_180_grayscale,
+            'grayscale_darken': grayscale_darken,
+            'grayscale_brighten': grayscale_brighten,
+            'grayscale_blur': grayscale_blur,
+            'rotate_270_grayscale': rotate_270_grayscale,
+            'zoom': zoom,
+        }
+        augmentations = collections.OrderedDict(
+            (name, AUGMENTATIONS[name]) for name in AUGMENTATIONS
+            if aug_all or selected[name])
+        augmentations.update(specs or {})
+        self.graph = AugmentationGraph(augmentations.values(), engine)
+        print("{} augmentations sharing {} steps per image".format(
+            self.graph.variant_count, self.graph.step_count))
+
+        self.codec = codec or ImageCodec()
+        self.encoder_threads = encoder_threads
+        self.spec_key = spec_key(
+            augmentations.values(), self.codec.describe(), engine)
+        self.seed = seed
+        self.manifest = Manifest(
+            "{}.manifest.jsonl".format(self.output_dir), resume)
+        self.input_infos = {}
+        if zipfile.is_zipfile(self.input_dir):
+            with zipfile.ZipFile(self.input_dir, 'r') as zip:
+                self.input_infos = {
+                    info.filename: info for info in zip.infolist()}
+
+        if stream:
+            self._augment_stream(workers, resume)
+            print("Done.")
+            self._write_report(
+                report, augmentations, time.perf_counter() - run_start)
+            return
+
         print("Unzipping files...")
+        start = time.perf_counter()
         if zipfile.is_zipfile(self.input_dir):
             print("Extracting " + self.input_dir + "...")
             with zipfile.ZipFile(self.input_dir, 'r') as zip:
                 zip.extractall(self.output_dir)
+        self.report.add('unzip', time.perf_counter() - start)
 
         # create the new directories for Annotations and JPEGImages
         self.new_annotation_path = os.path.join(self.output_dir, "Annotations")
         print("new annotation path: {}".format(self.new_annotation_path))
         self.new_image_directory = os.path.join(self.output_dir, 'JPEGImages')
 
-        # get all annotation files for a particular annotation task
-        annotation_files = get_all_file_paths(self.new_annotation_path)
-
-        print("Augmenting images...")
-        # read in annotation data one file at a time
-        for annotation_file in annotation_files:
-            # read in the annotation for the image
-            # print(annotation_file)
-            self.tree = ET.parse(annotation_file)
-            root = self.tree.getroot()
-
-            # make the new image path and name
-            image_name = root.find('filename').text
-            original_image_path = os.path.join(
-                self.output_dir, 'JPEGImages', image_name)
-            image = cv2.imread(original_image_path)
-            self.image_path = self.new_image_directory
-
-            # make a new annotation name and read in the annotation data
-            image_suffix_ind = image_name.rfind(".")
-            self.i = image_name[:image_suffix_ind]
-            self.i_suffix = image_name[image_suffix_ind:]
-
-            cv2.imwrite("{}{}".format(
-                os.path.join(self.image_path, self.i), self.i_suffix), image)
-
-            new_annotation_name = annotation_file[annotation_file.rfind(
-                os.sep) + 1:]
-            # write out the original image and annotation
-            self.tree.find('filename').text = "{}{}".format(
-                self.i, self.i_suffix)
-            print(os.path.join(
-                self.new_annotation_path, new_annotation_name))
-            self.tree.write(os.path.join(
-                self.new_annotation_path, new_annotation_name))
-
-            # Now augment the images and update the bounding boxes
-            # all the bounding boxes
-            bbs = []
-            for obj in root.findall('object'):
-                for box in obj.findall('bndbox'):
-                    x1 = float(box.find('xmin').text)
-                    x2 = float(box.find('xmax').text)
-                    y1 = float(box.find('ymin').text)
-                    y2 = float(box.find('ymax').text)
-
-                    bbs.append(BoundingBox(x1=x1, y1=y1, x2=x2, y2=y2))
-
-            # container for all the bounding boxes
-            bbs = BoundingBoxesOnImage(bbs, image.shape)
-
-            # flip the image 180
-            if rotate_180 or aug_all:
-                seq = iaa.Rot90(2)
-                rot180_image, rot180_bbs = seq(image=image, bounding_boxes=bbs)
-                self.write_augmented_files(
-                    rot180_bbs,
-                    rot180_image,
-                    "_rotate_180",
-                    new_annotation_name)
-
-            # darken the image
-            if darken or aug_all:
-                seq = iaa.Multiply((0.7, 0.8))
-                darkened_image, darkened_bbs = seq(
-                    image=image, bounding_boxes=bbs)
-                self.write_augmented_files(
-                    darkened_bbs,
-                    darkened_image,
-                    "_darkened",
-                    new_annotation_name)
-
-            # flip 90 degrees and darken
-            if rotate_90_darken or aug_all:
-                seq = iaa.Multiply((0.7, 0.8))
-                darkened_image, darkened_bbs = seq(
-                    image=image, bounding_boxes=bbs)
-                seq = iaa.Rot90(1)
-                darkened_rot90_image, darkened_rot90_bbs = seq(
-                    image=darkened_image, bounding_boxes=darkened_bbs)
-                self.write_augmented_files(
-                    darkened_rot90_bbs,
-                    darkened_rot90_image,
-                    "_darkened_rotate_90",
-                    new_annotation_name)
-
-            # flip 180 and darken
-            if rotate_180_darken or aug_all:
-                seq = iaa.Multiply((0.7, 0.8))
-                darkened_image, darkened_bbs = seq(
-                    image=image, bounding_boxes=bbs)
-                seq = iaa.Rot90(2)
-                dark_rot180_image, dark_rot180_bbs = seq(
-                    image=darkened_image, bounding_boxes=darkened_bbs)
-                self.write_augmented_files(
-                    dark_rot180_bbs,
-                    dark_rot180_image,
-                    "_darkened_rotate_180",
-                    new_annotation_name)
-
-            # brighten the image
-            if brighten or aug_all:
-                seq = iaa.Multiply((1.4, 1.6))
-                brightened_image, brightened_bbs_aug = seq(
-                    image=image, bounding_boxes=bbs)
-                self.write_augmented_files(
-                    brightened_bbs_aug,
-                    brightened_image,
-                    "_brightened",
-                    new_annotation_name)
-
-            # flip 180 and brighten
-            if rotate_brighten or aug_all:
-                seq = iaa.Multiply((1.4, 1.6))
-                brightened_image, brightened_bbs_aug = seq(
-                    image=image, bounding_boxes=bbs)
-                seq = iaa.Rot90(2)
-                bright_rot180_image, brightened_rot180_bbs = seq(
-                    image=brightened_image, bounding_boxes=brightened_bbs_aug)
-                self.write_augmented_files(
-                    brightened_rot180_bbs,
-                    bright_rot180_image,
-                    "_brightened_rotate_180",
-                    new_annotation_name)
-
-            # blur the image
-            if blur or aug_all:
-                seq = iaa.GaussianBlur(2)
-                blurred_image, blurred_bbs_aug = seq(
-                    image=image, bounding_boxes=bbs)
-                self.write_augmented_files(
-                    blurred_bbs_aug,
-                    blurred_image,
-                    "_blurred",
-                    new_annotation_name)
-
-            # flip 180 and blur
-            if rotate_180_blur or aug_all:
-                seq = iaa.GaussianBlur(2)
-                blurred_image, blurred_bbs_aug = seq(
-                    image=image, bounding_boxes=bbs)
-                seq = iaa.Rot90(2)
-                blurred_rot180_image, blurred_rot180_bbs = seq(
-                    image=blurred_image, bounding_boxes=blurred_bbs_aug)
-                self.write_augmented_files(
-                    blurred_rot180_bbs,
-                    blurred_rot180_image,
-                    "_blurred_rotate_180",
-                    new_annotation_name)
-
-            # flip 270 and darken
-            if rotate_270_darken or aug_all:
-                seq = iaa.Multiply((0.7, 0.8))
-                darkened_image, darkened_bbs = seq(
-                    image=image, bounding_boxes=bbs)
-                seq = iaa.Rot90(3)
-                rot270_darkened_image, rot270_darkened_bbs = seq(
-                    image=darkened_image, bounding_boxes=darkened_bbs)
-                self.write_augmented_files(
-                    rot270_darkened_bbs,
-                    rot270_darkened_image,
-                    "_rotate_270_darkened",
-                    new_annotation_name)
-
-            # - - - - GREYSCALE - - - - #
-            # just grayscale
-            if grayscale or aug_all:
-                seq = iaa.color.ChangeColorspace("GRAY")
-                gray_image, gray_bbs = seq(image=image, bounding_boxes=bbs)
-                self.write_augmented_files(
-                    gray_bbs,
-                    gray_image,
-                    "_grayscale",
-                    new_annotation_name)
-
-            # flip 90 and grayscale
-            if rotate_90_grayscale or aug_all:
-                seq = iaa.color.ChangeColorspace("GRAY")
-                gray_image, gray_bbs = seq(image=image, bounding_boxes=bbs)
-                seq = iaa.Rot90(1)
-                rot90_gray_image, rot90_gray_bbs = seq(
-                    image=gray_image, bounding_boxes=gray_bbs)
-                self.write_augmented_files(
-                    rot90_gray_bbs,
-                    rot90_gray_image,
-                    "_rotate_90_grayscale",
-                    new_annotation_name)
-
-            # flip 180 and grayscale
-            if rotate_180_grayscale or aug_all:
-                seq = iaa.color.ChangeColorspace("GRAY")
-                gray_image, gray_bbs = seq(image=image, bounding_boxes=bbs)
-                seq = iaa.Rot90(2)
-                rot180_gray_image, rot180_gray_bbs = seq(
-                    image=gray_image, bounding_boxes=gray_bbs)
-                self.write_augmented_files(
-                    rot180_gray_bbs,
-                    rot180_gray_image,
-                    "_rotate_180_grayscale",
-                    new_annotation_name)
-
-            # grayscale and darken
-            if grayscale_darken or aug_all:
-                seq = iaa.Multiply((0.7, 0.8))
-                darkened_image, darkened_bbs = seq(
-                    image=image, bounding_boxes=bbs)
-                seq = iaa.color.ChangeColorspace("GRAY")
-                dark_gray_image, dark_gray_bbs = seq(
-                    image=darkened_image, bounding_boxes=darkened_bbs)
-                self.write_augmented_files(
-                    dark_gray_bbs,
-                    dark_gray_image,
-                    "_grayscale_darkened",
-                    new_annotation_name)
-
-            # grayscale and brighten
-            if grayscale_brighten or aug_all:
-                seq = iaa.Multiply((1.4, 1.6))
-                brightened_image, brightened_bbs_aug = seq(
-                    image=image, bounding_boxes=bbs)
-                seq = iaa.color.ChangeColorspace("GRAY")
-                bright_gray_image, bright_gray_bbs = seq(
-                    image=brightened_image, bounding_boxes=brightened_bbs_aug)
-                self.write_augmented_files(
-                    bright_gray_bbs,
-                    bright_gray_image,
-                    "_grayscale_brightened",
-                    new_annotation_name)
-
-            # grayscale and blur
-            if grayscale_blur or aug_all:
-                seq = iaa.GaussianBlur(2)
-                blurred_image, blurred_bbs_aug = seq(
-                    image=image, bounding_boxes=bbs)
-                seq = iaa.color.ChangeColorspace("GRAY")
-                blurred_gray_image, blurred_gray_bbs = seq(
-                    image=blurred_image, bounding_boxes=blurred_bbs_aug)
-                self.write_augmented_files(
-                    blurred_gray_bbs,
-                    blurred_gray_image,
-                    "_grayscale_blurred",
-                    new_annotation_name)
-
-            # flip 270 and grayscale
-            if rotate_270_grayscale or aug_all:
-                seq = iaa.color.ChangeColorspace("GRAY")
-                gray_image, gray_bbs = seq(image=image, bounding_boxes=bbs)
-                seq = iaa.Rot90(3)
-                rot270_gray_image, rot270_gray_bbs = seq(
-                    image=gray_image, bounding_boxes=gray_bbs)
-                self.write_augmented_files(
-                    rot270_gray_bbs,
-                    rot270_gray_image,
-                    "_rotate_270_grayscale",
-                    new_annotation_name)
-
-            # - - - - ZOOM - - - - #
-            if zoom or aug_all:
-                seq = iaa.Affine(scale={"x": (0.6, 1.0), "y": (0.6, 1.0)})
-                zoomed_image, zoom_bbs = seq(image=image, bounding_boxes=bbs)
-                self.write_augmented_files(
-                    zoom_bbs,
-                    zoomed_image,
-                    "_zoomed",
-                    new_annotation_name)
+        # get all annotation files for a particular annotation task, from
+        # the input zip so outputs of an earlier run are never picked up
+        annotation_members = [
+            name for name in self.input_infos
+            if is_annotation_member(name)]
+        annotation_files = [
+            os.path.join(self.output_dir, *name.split('/'))
+            for name in annotation_members]
+
+        if resume and self.graph.variant_count:
+            start = time.perf_counter()
+            annotation_files = self._resume_directory(
+                annotation_files, annotation_members)
+            self.report.add('resume', time.perf_counter() - start)
+
+        if not self.graph.variant_count:
+            print("No augmentations selected, dataset copied as is.")
+        elif workers > 1:
+            print("Augmenting images...")
+            self._augment_parallel(annotation_files, workers)
+        else:
+            print("Augmenting images...")
+            # read in annotation data one file at a time
+            self._augment_serial(annotation_files, self.augment_file)
 
         print("Zipping files...")
+        start = time.perf_counter()
         shutil.make_archive(
             "{}".format(self.output_dir), "zip", self.output_dir)
+        self.report.add('zip', time.perf_counter() - start)
+        self.manifest.compact(annotation_members)
         print("Done.")
+        start = time.perf_counter()
         shutil.rmtree(self.output_dir)
+        self.report.add('cleanup', time.perf_counter() - start)
+        self._write_report(
+            report, augmentations, time.perf_counter() - run_start)
 
         # aug_zip = zipfile.ZipFile("{}.zip".format(self.output_dir), 'w')
 
@@ -411,10 +1535,55 @@ if __name__ == "__main__":
         parser.add_argument(
             '--rotate_270_grayscale', action='store_true')
         parser.add_argument('--zoom', action='store_true')
+        parser.add_argument(
+            '--spec', type=str, action='append', default=[],
+            help='An augmentation pipeline spec: a JSON/YAML file, or an inline string such as "darken;tilt=rot90:1+multiply:1.1:1.2".')
+        parser.add_argument(
+            '--engine', type=str, choices=ENGINES, default='fast',
+            help='Run rotations, brightness and grayscale as array operations (fast) or through imgaug.')
+        parser.add_argument(
+            '--output_dir', type=str,
+            help='The name of the output, without .zip. A timestamped name is used if not specified.')
+        parser.add_argument(
+            '--resume', action='store_true',
+            help='Continue a partially written output, or update a previous one, only augmenting new or changed images.')
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help='The number of worker processes to shard the images across.')
+        parser.add_argument(
+            '--stream', action='store_true',
+            help='Stream the input zip straight into the output zip instead of extracting it to disk.')
+        parser.add_argument(
+            '--image_format', type=str, choices=IMAGE_FORMATS,
+            help='The format of the augmented images. The format of each source image is kept if not specified.')
+        parser.add_argument(
+            '--jpeg_quality', type=int,
+            help='JPEG quality from 0 to 100, OpenCV defaults to 95.')
+        parser.add_argument('--jpeg_optimize', action='store_true')
+        parser.add_argument('--jpeg_progressive', action='store_true')
+        parser.add_argument(
+            '--webp_quality', type=int,
+            help='WebP quality from 1 to 100, lossless if not specified.')
+        parser.add_argument(
+            '--png_compression', type=int,
+            help='PNG compression level from 0 to 9, OpenCV defaults to 1.')
+        parser.add_argument(
+            '--seed', type=int,
+            help='Base seed for the random augmentation parameters. Each image and augmentation gets its own seed derived from it, so the output is the same for any number of workers.')
+        parser.add_argument(
+            '--report', type=str,
+            help='Path of a JSON file to write the run timings to: totals per stage, step and augmentation, per-image percentiles and the slowest images.')
+        parser.add_argument(
+            '--encoder_threads', type=int, default=2,
+            help='The number of threads encoding and writing images in each process, 0 to encode inline.')
 
         args = parser.parse_args()
         print(args)
 
+        specs = collections.OrderedDict()
+        for spec in args.spec:
+            specs.update(load_spec(spec))
+
         augmenter = Augmenter(args.input_dir)
         augmenter.augment_images(
             aug_all=args.all,
@@ -434,7 +1603,23 @@ if __name__ == "__main__":
             grayscale_brighten=args.grayscale_brighten,
             grayscale_blur=args.grayscale_blur,
             rotate_270_grayscale=args.rotate_270_grayscale,
-            zoom=args.zoom
+            zoom=args.zoom,
+            workers=args.workers,
+            stream=args.stream,
+            specs=specs,
+            engine=args.engine,
+            output_dir=args.output_dir,
+            resume=args.resume,
+            codec=ImageCodec(
+                image_format=args.image_format,
+                jpeg_quality=args.jpeg_quality,
+                jpeg_optimize=args.jpeg_optimize,
+                jpeg_progressive=args.jpeg_progressive,
+                webp_quality=args.webp_quality,
+                png_compression=args.png_compression),
+            encoder_threads=args.encoder_threads,
+            seed=args.seed,
+            report=args.report
             )
     except RuntimeError as err:
         print(err)
@@ -0,0 +1,183 @@
+import collections
+import itertools
+import multiprocessing
+import random
+import xml.etree.ElementTree as ET
+
+import cv2
+import numpy as np
+
+from augment_images import (
+    AugmentationGraph, _init_worker, derive_seed, read_boxes)
+from zip_utils import DatasetReader, image_member
+
+
+def read_labels(root):
+    """
+    Reads the label of every bounding box of an annotation, in the same
+    order as read_boxes
+    :param root: the root element of the annotation
+    :return: list of label names
+    """
+    return [
+        obj.find('name').text
+        for obj in root.findall('object')
+        for _ in obj.findall('bndbox')]
+
+
+class SampleLoader:
+    """
+    Loads one annotated image of a dataset and runs the augmentations on it
+    """
+    def __init__(self, source, augmentations, engine, include_original):
+        self.reader = DatasetReader(source)
+        self.graph = AugmentationGraph(augmentations, engine)
+        self.include_original = include_original
+
+    def load(self, annotation_member, seed=None):
+        """
+        :param seed: optional base seed of the augmentations
+        :return: list of (image, boxes, labels) samples of one annotation,
+            none sharing memory with another
+        """
+        root = ET.fromstring(self.reader.read(annotation_member))
+        member = image_member(annotation_member, root.find('filename').text)
+        image = cv2.imdecode(
+            np.frombuffer(self.reader.read(member), np.uint8),
+            cv2.IMREAD_COLOR)
+        if image is None:
+            raise RuntimeError("Invalid image member {}".format(member))
+
+        boxes = read_boxes(root)
+        labels = read_labels(root)
+        outputs = []
+        if self.include_original:
+            outputs.append((image, boxes))
+        image_seed = None if seed is None \
+            else derive_seed(seed, annotation_member)
+        for _, aug_image, aug_boxes in self.graph.run(
+                image, boxes, image_seed):
+            outputs.append((aug_image, aug_boxes))
+        # steps return views of, or the very arrays of, their inputs, and
+        # the graph shares them between augmentations, so every sample gets
+        # its own copies; a consumer may then modify one in place, with or
+        # without worker processes
+        return [
+            (np.array(aug_image, order='C'), aug_boxes.copy(), list(labels))
+            for aug_image, aug_boxes in outputs]
+
+
+# the loader of each prefetching worker process
+_worker_loader = None
+
+
+def _init_loader_worker(params):
+    global _worker_loader
+    _init_worker()
+    _worker_loader = SampleLoader(*params)
+
+
+def _load_in_worker(annotation_member, seed):
+    return _worker_loader.load(annotation_member, seed)
+
+
+class AugmentedDataset:
+    """
+    Iterates over the augmented samples of a Pascal VOC dataset in memory,
+    without writing anything to disk. Each pass yields (image, boxes,
+    labels) tuples: a BGR uint8 image, an (N, 4) float32 array of x1, y1,
+    x2, y2 and the N label names. Every sample owns its arrays and list, so
+    they can be modified in place. Iterate again for the next epoch.
+
+        dataset = AugmentedDataset(
+            'dataset.zip', load_spec('darken;grayscale').values(),
+            shuffle=True, workers=4)
+        for epoch in range(epochs):
+            for image, boxes, labels in dataset:
+                ...
+    """
+    def __init__(
+            self, source, augmentations, engine='fast',
+            include_original=True, shuffle=False, seed=None, workers=0,
+            prefetch=16):
+        """
+        :param source: a zipped dataset or an extracted dataset folder
+        :param augmentations: iterable of (suffix, steps) pairs, for
+            example the values of AUGMENTATIONS or of load_spec
+        :param engine: the engine to run the steps with, see ENGINES
+        :param include_original: also yield the original samples
+        :param shuffle: shuffle the images, and the samples of each image,
+            every epoch
+        :param seed: seed of the shuffling and of the augmentations; every
+            epoch differs, but the same epoch is reproducible whatever the
+            number of workers
+        :param workers: the number of worker processes loading and
+            augmenting images in the background; 0 loads them in the
+            iterating process
+        :param prefetch: the maximum number of images loaded ahead of the
+            consumer, which bounds the memory held by queued samples
+        """
+        self.params = (
+            source, list(augmentations), engine, include_original)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.workers = workers
+        self.prefetch = max(1, prefetch)
+        self.epoch = 0
+
+        reader = DatasetReader(source)
+        self.annotation_members = reader.annotation_members()
+        reader.close()
+        self.samples_per_image = int(include_original) + \
+            AugmentationGraph(self.params[1], engine).variant_count
+
+    def __len__(self):
+        return len(self.annotation_members) * self.samples_per_image
+
+    def __iter__(self):
+        members = list(self.annotation_members)
+        epoch_seed = None if self.seed is None \
+            else derive_seed(self.seed, self.epoch)
+        rng = random.Random(epoch_seed)
+        self.epoch += 1
+        if self.shuffle:
+            rng.shuffle(members)
+
+        for samples in self._load_all(members, epoch_seed):
+            if self.shuffle:
+                rng.shuffle(samples)
+            yield from samples
+
+    def _load_all(self, members, seed):
+        """
+        Loads the samples of each image in order, at most prefetch images
+        ahead of the consumer
+        """
+        if self.workers <= 0:
+            loader = SampleLoader(*self.params)
+            try:
+                for member in members:
+                    yield loader.load(member, seed)
+            finally:
+                loader.reader.close()
+            return
+
+        pool = multiprocessing.Pool(
+            self.workers, initializer=_init_loader_worker,
+            initargs=(self.params,))
+        try:
+            members = iter(members)
+            queue = collections.deque(
+                pool.apply_async(_load_in_worker, (member, seed))
+                for member in itertools.islice(members, self.prefetch))
+            while queue:
+                samples = queue.popleft().get()
+                member = next(members, None)
+                if member is not None:
+                    queue.append(
+                        pool.apply_async(_load_in_worker, (member, seed)))
+                yield samples
+        finally:
+            # also stops the workers when the consumer stops iterating early
+            pool.terminate()
+            pool.join()
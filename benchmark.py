@@ -0,0 +1,420 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+
+import cv2
+import numpy as np
+
+from augment_images import AUGMENTATIONS, ENGINES, AugmentationGraph
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+LABELS = ('person', 'car', 'bicycle', 'dog', 'cat')
+# label_converter.py reads its mappings from the working directory
+LABEL_MAPPINGS = (('bicycle', 'bike'), ('cat', 'omit'))
+TOOLS = ('augment_images', 'label_converter', 'test_annotations',
+         'class_balancer')
+# runs a tool in place of its own script and, when it exits, writes the
+# I/O counters and peak resident set size of that process as JSON. The I/O
+# counters include every child process the tool has waited for. Measured
+# from the outside, ru_maxrss from wait4 would carry over this harness's
+# own peak through the fork, and the harness's own /proc/self/io would
+# count the reads of the worker sampler.
+MEASURE_LAUNCHER = """
+import json, os, runpy, sys
+report, script = sys.argv[1:3]
+sys.argv = sys.argv[2:]
+sys.path.insert(0, os.path.dirname(script))
+try:
+    runpy.run_path(script, run_name='__main__')
+finally:
+    # read the counters before anything else adds to them
+    measures = {}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                measures[key] = int(value)
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    measures['peak_rss'] = int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    with open(report, 'w') as f:
+        json.dump(measures, f)
+"""
+# how often the workers of a running tool are sampled
+RSS_POLL_SECONDS = 0.02
+
+
+def make_sample(width, height, boxes_per_image, seed=0):
+    """
+    Generates a random image and random boxes inside it
+    :param width: image width
+    :param height: image height
+    :param boxes_per_image: number of boxes
+    :param seed: seed for the random generator
+    :return: the image and an (N, 4) float32 array of x1, y1, x2, y2
+    """
+    rng = np.random.RandomState(seed)
+    image = rng.randint(0, 256, (height, width, 3), dtype=np.uint8)
+    corners = rng.rand(boxes_per_image, 2) * [width * 0.8, height * 0.8]
+    sizes = rng.rand(boxes_per_image, 2) * [width * 0.2, height * 0.2] + 1
+    boxes = np.hstack([corners, corners + sizes]).astype(np.float32)
+    return image, boxes
+
+
+def make_dataset(path, images, width, height, boxes_per_image, seed=0):
+    """
+    Writes a synthetic zipped Pascal VOC dataset
+    :param path: path of the zip file to write
+    :param images: number of images
+    :param width: image width
+    :param height: image height
+    :param boxes_per_image: number of boxes per image
+    :param seed: seed for the random generator
+    """
+    rng = random.Random(seed)
+    # smooth images compress like photos, unlike pure noise
+    base, _ = make_sample(width // 8 + 1, height // 8 + 1, 0, seed)
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as target:
+        for index in range(images):
+            image = cv2.resize(
+                np.roll(base, index, axis=1), (width, height),
+                interpolation=cv2.INTER_LINEAR)
+            _, boxes = make_sample(width, height, boxes_per_image, index)
+            boxes = np.minimum(boxes, [width, height, width, height])
+            name = "image_{:06d}".format(index)
+            target.writestr(
+                "JPEGImages/{}.jpg".format(name),
+                cv2.imencode('.jpg', image)[1].tobytes())
+
+            objects = "".join(
+                "<object><name>{}</name><pose>Unspecified</pose>"
+                "<truncated>0</truncated><difficult>0</difficult><bndbox>"
+                "<xmin>{}</xmin><ymin>{}</ymin><xmax>{}</xmax><ymax>{}</ymax>"
+                "</bndbox></object>".format(
+                    rng.choice(LABELS), *[int(value) for value in box])
+                for box in boxes)
+            target.writestr(
+                "Annotations/{}.xml".format(name),
+                "<annotation><folder>JPEGImages</folder>"
+                "<filename>{}.jpg</filename><size><width>{}</width>"
+                "<height>{}</height><depth>3</depth></size>{}"
+                "</annotation>".format(name, width, height, objects))
+
+
+def _peak_rss(pid):
+    """
+    :return: the peak resident set size of a running process in bytes, or
+        None once it has exited
+    """
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def _descendants(pid):
+    """
+    :return: the ids of every running descendant of a process
+    """
+    children = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(name)) as f:
+                # the command name may hold spaces, but ends at the last ')'
+                ppid = int(f.read().rpartition(')')[2].split()[1])
+        except (IOError, OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(name))
+    found = []
+    pending = children.get(pid, [])
+    while pending:
+        child = pending.pop()
+        found.append(child)
+        pending.extend(children.get(child, []))
+    return found
+
+
+def _sample_workers(pid, peaks, done):
+    """
+    Records the peak resident set size of every descendant of a process
+    until done is set, sampling them every RSS_POLL_SECONDS
+    """
+    while not done.wait(RSS_POLL_SECONDS):
+        for worker in _descendants(pid):
+            peak = _peak_rss(worker)
+            if peak is not None:
+                peaks[worker] = max(peak, peaks.get(worker, 0))
+
+
+def run_tool(script, args, work_dir, images):
+    """
+    Runs one of the tools as a child process and measures it
+    :param script: file name of the tool in this folder
+    :param args: command line arguments of the tool
+    :param work_dir: the working directory of the tool
+    :param images: the number of source images the run processes
+    :return: dictionary of the measurements
+    """
+    log_path = os.path.join(work_dir, 'benchmark.log')
+    measures_path = os.path.join(work_dir, 'benchmark.json')
+    command = [
+        sys.executable, '-c', MEASURE_LAUNCHER, measures_path,
+        os.path.join(TOOLS_DIR, script)] + args
+    # the peak of each worker process, sampled while it runs
+    worker_peaks = {}
+    start = time.perf_counter()
+    with open(log_path, 'wb') as log:
+        process = subprocess.Popen(
+            command, cwd=work_dir, stdout=log, stderr=subprocess.STDOUT)
+        done = threading.Event()
+        sampler = threading.Thread(
+            target=_sample_workers, args=(process.pid, worker_peaks, done))
+        sampler.start()
+        _, status = os.waitpid(process.pid, 0)
+        done.set()
+        sampler.join()
+    seconds = time.perf_counter() - start
+    try:
+        with open(measures_path) as f:
+            measures = json.load(f)
+        os.remove(measures_path)
+    except (IOError, OSError, ValueError):
+        measures = {}
+
+    result = {
+        'command': " ".join([script] + args),
+        'seconds': seconds,
+        'images': images,
+        'images_per_sec': images / seconds if seconds else None,
+        # the tool's own process, measured from inside it at exit
+        'peak_rss_bytes': measures.get('peak_rss'),
+        # summed over the worker processes; pages shared with the tool at
+        # fork count towards both
+        'workers_peak_rss_bytes': sum(worker_peaks.values()),
+        'workers': len(worker_peaks),
+        # the tool and the workers it has waited for, from inside the tool
+        'bytes_read': measures.get('rchar'),
+        'bytes_written': measures.get('wchar'),
+        'storage_bytes_read': measures.get('read_bytes'),
+        'storage_bytes_written': measures.get('write_bytes'),
+        'exit_code': os.waitstatus_to_exitcode(status)
+        if hasattr(os, 'waitstatus_to_exitcode') else status,
+    }
+    # the tools print their errors rather than failing, so keep the end of
+    # the log to tell a failed run from a fast one
+    with open(log_path, 'rb') as log:
+        result['log_tail'] = log.read()[-500:].decode('utf-8', 'replace')
+    os.remove(log_path)
+    return result
+
+
+def _clean(work_dir, keep):
+    for name in os.listdir(work_dir):
+        if name not in keep:
+            path = os.path.join(work_dir, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+
+def benchmark_tools(work_dir, dataset, images, tools=TOOLS, variants=True):
+    """
+    Runs every tool, and augment_images.py once per augmentation, on a
+    dataset in the working directory
+    :param work_dir: directory holding the dataset
+    :param dataset: file name of the zipped dataset in work_dir
+    :param images: the number of images of the dataset
+    :param tools: the tools to run
+    :param variants: also run each augmentation on its own
+    :return: dictionary of case name to measurements
+    """
+    cases = []
+    if 'augment_images' in tools:
+        augment = ['--input_dir', dataset, '--output_dir', 'augmented']
+        if variants:
+            cases += [
+                ('augment_images:{}'.format(name), 'augment_images.py',
+                 augment + ['--{}'.format(name)])
+                for name in AUGMENTATIONS]
+        cases += [
+            ('augment_images:none', 'augment_images.py', augment),
+            ('augment_images:all', 'augment_images.py', augment + ['--all']),
+            ('augment_images:all_stream', 'augment_images.py',
+             augment + ['--all', '--stream']),
+        ]
+    if 'label_converter' in tools:
+        cases.append((
+            'label_converter', 'label_converter.py',
+            ['--input_dir', dataset, '--output_dir', 'renamed']))
+    if 'test_annotations' in tools:
+        cases.append((
+            'test_annotations', 'test_annotations.py',
+            ['--input_dir', dataset, '--output_dir', 'tested']))
+    if 'class_balancer' in tools:
+        # the full analysis needs edgeiq; --counts_only runs without it
+        cases += [
+            ('class_balancer', 'class_balancer.py',
+             ['--input_dir', 'extracted']),
+            ('class_balancer:counts_only', 'class_balancer.py',
+             ['--input_dir', 'extracted', '--counts_only']),
+        ]
+
+    keep = set(os.listdir(work_dir))
+    results = {}
+    for name, script, args in cases:
+        # every run starts from the dataset alone, with untimed setup
+        _clean(work_dir, keep)
+        if script == 'label_converter.py':
+            with open(os.path.join(work_dir, 'label_mappings.csv'), 'w') as f:
+                f.writelines(
+                    "{},{}\n".format(bad, good)
+                    for bad, good in LABEL_MAPPINGS)
+        elif script == 'class_balancer.py':
+            with zipfile.ZipFile(os.path.join(work_dir, dataset)) as source:
+                source.extractall(os.path.join(work_dir, 'extracted'))
+        print("Running {}...".format(name))
+        results[name] = run_tool(script, args, work_dir, images)
+    _clean(work_dir, keep)
+    return results
+
+
+def time_graph(graph, image, boxes, repeat):
+    """
+    Times running an augmentation graph over one image
+    :return: the best seconds per image over the repeats
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in graph.run(image, boxes):
+            pass
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def benchmark_engines(width, height, boxes_per_image, repeat):
+    """
+    Compares the per-image time of every predefined augmentation, and of
+    all of them together, between the fast and imgaug engines
+    :return: dictionary of augmentation name to seconds per engine
+    """
+    image, boxes = make_sample(width, height, boxes_per_image)
+    cases = [(name, [AUGMENTATIONS[name]]) for name in AUGMENTATIONS]
+    cases.append(('all', list(AUGMENTATIONS.values())))
+
+    results = {}
+    for name, augmentations in cases:
+        results[name] = {
+            engine: time_graph(
+                AugmentationGraph(augmentations, engine), image, boxes,
+                repeat)
+            for engine in ENGINES}
+        results[name]['speedup'] = \
+            results[name]['imgaug'] / results[name]['fast']
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=TOOLS_DIR,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='alwaysAI Data Tools Benchmark')
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--boxes', type=int, default=20)
+    parser.add_argument(
+        '--images', type=int, default=100,
+        help='The number of images in the synthetic dataset.')
+    parser.add_argument(
+        '--repeat', type=int, default=5,
+        help='Runs per engine case; the fastest run is reported.')
+    parser.add_argument(
+        '--only', type=str, choices=('engines', 'tools'),
+        help='Only compare the augmentation engines, or only run the tools.')
+    parser.add_argument(
+        '--tools', type=str, nargs='+', choices=TOOLS, default=list(TOOLS),
+        help='The tools to run.')
+    parser.add_argument(
+        '--no_variants', action='store_true',
+        help='Skip running each augmentation on its own.')
+    parser.add_argument(
+        '--work_dir', type=str,
+        help='Where to generate the dataset and run the tools. A temporary directory is used, and removed, if not specified.')
+    parser.add_argument(
+        '--output', type=str,
+        help='Path of a JSON file to write the results to.')
+    args = parser.parse_args()
+
+    results = {
+        'commit': _git_commit(),
+        'config': {
+            'images': args.images, 'width': args.width,
+            'height': args.height, 'boxes': args.boxes,
+        },
+    }
+
+    if args.only != 'tools':
+        results['engines'] = benchmark_engines(
+            args.width, args.height, args.boxes, args.repeat)
+        print("{:<24}{:>12}{:>12}{:>10}".format(
+            "augmentation", "fast ms", "imgaug ms", "speedup"))
+        for name, result in results['engines'].items():
+            print("{:<24}{:>12.2f}{:>12.2f}{:>9.1f}x".format(
+                name, result['fast'] * 1000, result['imgaug'] * 1000,
+                result['speedup']))
+
+    if args.only != 'engines':
+        work_dir = args.work_dir or tempfile.mkdtemp(prefix='benchmark-')
+        if not os.path.exists(work_dir):
+            os.makedirs(work_dir)
+        try:
+            print("Generating {} images of {}x{}...".format(
+                args.images, args.width, args.height))
+            make_dataset(
+                os.path.join(work_dir, 'dataset.zip'), args.images,
+                args.width, args.height, args.boxes)
+            results['tools'] = benchmark_tools(
+                work_dir, 'dataset.zip', args.images, args.tools,
+                not args.no_variants)
+        finally:
+            if args.work_dir is None:
+                shutil.rmtree(work_dir)
+
+        print("{:<34}{:>10}{:>10}{:>10}{:>10}{:>10}".format(
+            "tool", "images/s", "peak MB", "read MB", "write MB", "exit"))
+        for name, result in results['tools'].items():
+            print("{:<34}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}{:>10}".format(
+                name, result['images_per_sec'],
+                ((result['peak_rss_bytes'] or 0) +
+                 result['workers_peak_rss_bytes']) / 1e6,
+                (result['bytes_read'] or 0) / 1e6,
+                (result['bytes_written'] or 0) / 1e6, result['exit_code']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
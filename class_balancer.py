@@ -1,15 +1,184 @@
 import argparse
+import collections
+import heapq
+import json
+import math
 import os
 import shutil
+import sqlite3
 import xml.etree.ElementTree as et
-import edgeiq
-import random
+import numpy as np
 
 
 def _convert_xml_float_2_int(v):
     return int(round(float(v)))
 
 
+def _fewest_to_cover(values, total):
+    """
+    :return: the fewest of the values that add up to at least total
+    """
+    covered = np.cumsum(np.sort(values)[::-1])
+    return int(np.searchsorted(covered, total)) + 1 \
+        if covered.size and covered[-1] >= total else covered.size
+
+
+def _removal_lower_bound(matrix, need, gains):
+    """
+    A lower bound on the number of files any solution has to remove: the
+    fewest files that could cover the need of each class on its own, or the
+    total need, if every file removed counted in full.
+    """
+    if not need.any():
+        return 0
+    bound = _fewest_to_cover(gains, need.sum())
+    for c in np.flatnonzero(need):
+        bound = max(bound, _fewest_to_cover(
+            np.minimum(matrix[:, c], need[c]), need[c]))
+    return bound
+
+
+def _greedy_removal(matrix, need, slack):
+    """
+    Chooses the files to remove so that each class loses at least its need,
+    and at most its slack, of objects. Files are removed greedily by how much
+    of the remaining need they cover, with ties going to the earlier file.
+    Gains only shrink as the need is covered, so stale heap entries are
+    re-evaluated lazily, in near linear time overall.
+
+    :param matrix: (files, classes) array of object counts
+    :param need: per class, the objects that have to be removed
+    :param slack: per class, the most objects that may be removed
+    :returns: list -- the removed rows, in order of removal
+    :returns: array -- the objects removed per class
+    :returns: int -- lower bound on the rows any solution removes
+    """
+    need = np.asarray(need, dtype=np.int64)
+    slack = np.asarray(slack, dtype=np.int64)
+
+    # a file that alone exceeds the slack of a class can never be removed
+    candidates = np.flatnonzero((matrix <= slack).all(axis=1))
+    gains = np.minimum(matrix[candidates], need).sum(axis=1)
+    candidates, gains = candidates[gains > 0], gains[gains > 0]
+    candidate_counts = matrix[candidates]
+    lower_bound = _removal_lower_bound(candidate_counts, need, gains)
+
+    # the nonzero counts of each candidate, as plain lists, since most
+    # files hold few classes and the loop below touches one file at a time
+    file_ids, classes = np.nonzero(candidate_counts)
+    values = candidate_counts[file_ids, classes].tolist()
+    starts = np.searchsorted(
+        file_ids, np.arange(len(candidates) + 1)).tolist()
+    classes = classes.tolist()
+    need, slack = need.tolist(), slack.tolist()
+    removed = [0] * len(need)
+    remaining = sum(need)
+
+    heap = list(zip((-gains).tolist(), range(len(candidates))))
+    heapq.heapify(heap)
+    chosen = []
+    while heap and remaining:
+        _, i = heapq.heappop(heap)
+        counts = list(zip(
+            classes[starts[i]:starts[i + 1]], values[starts[i]:starts[i + 1]]))
+        # the slack only shrinks, so a file that no longer fits never will
+        if any(count > slack[c] for c, count in counts):
+            continue
+        gain = sum(min(count, need[c]) for c, count in counts)
+        if not gain:
+            continue
+        if heap and (-gain, i) > heap[0]:
+            heapq.heappush(heap, (-gain, i))
+            continue
+        chosen.append(int(candidates[i]))
+        remaining -= gain
+        for c, count in counts:
+            need[c] = max(need[c] - count, 0)
+            slack[c] -= count
+            removed[c] += count
+    return chosen, np.array(removed, dtype=np.int64), lower_bound
+
+
+def _count_file_labels(path):
+    """
+    :return: dictionary of label to number of objects in an annotation file
+    """
+    root = et.parse(path).getroot()
+    return dict(collections.Counter(
+        name.text for name in root.iterfind('object/name')))
+
+
+class AnnotationIndex:
+    """
+    Persistent per-file label counts of annotation folders, in an SQLite
+    file, so that repeated analysis only parses new or changed annotations.
+    A file is reparsed whenever its mtime or size changes, and files no
+    longer in the folder are dropped from the index.
+
+    Typical usage::
+
+        index = AnnotationIndex('annotations.sqlite')
+        fnames_class = index.update(annotations_dir, count_labels)
+        index.close()
+    """
+    def __init__(self, index_path):
+        self.connection = sqlite3.connect(index_path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS annotations ('
+            'directory TEXT, name TEXT, mtime_ns INTEGER, size INTEGER, '
+            'counts TEXT, PRIMARY KEY (directory, name))')
+        self.parsed = 0
+        self.loaded = 0
+
+    def update(self, directory, count_labels):
+        """
+        Brings the index of an annotation folder up to date.
+
+        :type directory: string
+        :param directory: The folder holding the .xml annotation files
+        :param count_labels: function of an annotation path returning its
+            dictionary of label to object count
+        :returns: dictionary -- file name to its dictionary of label counts
+        """
+        directory = os.path.realpath(directory)
+        cached = {
+            name: (mtime_ns, size, counts)
+            for name, mtime_ns, size, counts in self.connection.execute(
+                'SELECT name, mtime_ns, size, counts FROM annotations '
+                'WHERE directory = ?', (directory,))}
+
+        fnames_class = {}
+        changed = []
+        for entry in os.scandir(directory):
+            if not entry.name.endswith('.xml') or not entry.is_file():
+                continue
+            stat = entry.stat()
+            row = cached.pop(entry.name, None)
+            if row is not None and row[:2] == (stat.st_mtime_ns, stat.st_size):
+                fnames_class[entry.name] = json.loads(row[2])
+                continue
+            counts = count_labels(entry.path)
+            fnames_class[entry.name] = counts
+            changed.append((
+                directory, entry.name, stat.st_mtime_ns, stat.st_size,
+                json.dumps(counts)))
+
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO annotations VALUES (?, ?, ?, ?, ?)',
+                changed)
+            # whatever is left was deleted or moved out of the folder
+            self.connection.executemany(
+                'DELETE FROM annotations WHERE directory = ? AND name = ?',
+                [(directory, name) for name in cached])
+        self.parsed = len(changed)
+        self.loaded = len(fnames_class) - len(changed)
+        return fnames_class
+
+    def close(self):
+        self.connection.close()
+
+
 class ClassBalancer:
     """
     Analyze and balance the class distribution of dataset available in PASCAL-VOC format.
@@ -29,14 +198,21 @@ class ClassBalancer:
     def __init__(self):
         self.dict_fnames_class = {}
         self.class_distribution = {}
+        self.solver_stats = {}
 
-    def _parse_voc_annotations(self, input_dir):
+    def _set_paths(self, input_dir):
         self.path_annotations = os.path.join(input_dir, 'Annotations')
         self.path_images = os.path.join(input_dir, 'JPEGImages')
         self.path_holdout_dir = os.path.join(input_dir, 'holdout')
         self.path_holdout_annotations = os.path.join(self.path_holdout_dir, 'Annotations')
         self.path_holdout_images = os.path.join(self.path_holdout_dir, 'JPEGImages')
 
+    def _parse_voc_annotations(self, input_dir):
+        # only this full parse needs edgeiq, which is slow to import
+        import edgeiq
+
+        self._set_paths(input_dir)
+
         frame_predictions = {}
         all_predictions = []
         class_predictions = {}
@@ -82,26 +258,83 @@ class ClassBalancer:
             self.dict_fnames_class = class_fnames
         return frame_predictions, all_predictions, class_predictions
 
-    def analyze_dataset(self, path):
+    def _count_voc_annotations(self, input_dir, index_path=None):
+        """
+        Counts the objects of each label in each annotation file, keeping
+        nothing but the integer counts, and without importing edgeiq.
+
+        :returns: dictionary -- file name to its dictionary of label counts
+        """
+        self._set_paths(input_dir)
+        if index_path is None:
+            return {
+                entry.name: _count_file_labels(entry.path)
+                for entry in os.scandir(self.path_annotations)
+                if entry.name.endswith('.xml') and entry.is_file()}
+
+        index = AnnotationIndex(index_path)
+        try:
+            fnames_class = index.update(
+                self.path_annotations, _count_file_labels)
+        finally:
+            index.close()
+        print("Parsed %d new or changed annotation files, loaded %d from %s" % (
+            index.parsed, index.loaded, index_path))
+        return fnames_class
+
+    def analyze_dataset(self, path, index_path=None, counts_only=False):
         """
         Get class distribution for input dataset.
 
         :type path: string
         :param path: The path to dataset folder
+        :type index_path: string
+        :param index_path: Optional path of an AnnotationIndex file; only
+            annotations that are new or changed since the last run are parsed
+        :type counts_only: bool
+        :param counts_only: Only count the labels of each file, without
+            building edgeiq predictions; implied by index_path
         :returns: dictionary -- sorted class distribution of the dataset
         """
-        frame_predictions, all_predictions, class_predictions = \
-            self._parse_voc_annotations(path)
-        self.class_distribution = {
-            i: len(class_predictions[i]) for i in class_predictions.keys()}
+        if counts_only or index_path is not None:
+            self.dict_fnames_class = self._count_voc_annotations(
+                path, index_path)
+            self.class_distribution = collections.Counter()
+            for counts in self.dict_fnames_class.values():
+                self.class_distribution.update(counts)
+        else:
+            frame_predictions, all_predictions, class_predictions = \
+                self._parse_voc_annotations(path)
+            self.class_distribution = {
+                i: len(class_predictions[i]) for i in class_predictions.keys()}
         self.class_distribution = dict(
             sorted(self.class_distribution.items(), key=lambda x: x[1]))
         return self.class_distribution
 
+    def _count_matrix(self):
+        """
+        :returns: list -- the annotation file names, sorted
+        :returns: list -- the class labels, in class_distribution order
+        :returns: array -- (files, classes) matrix of object counts
+        """
+        fnames = sorted(self.dict_fnames_class)
+        labels = list(self.class_distribution)
+        columns = {label: i for i, label in enumerate(labels)}
+        matrix = np.zeros((len(fnames), len(labels)), dtype=np.int32)
+        for row, fname in enumerate(fnames):
+            for label, count in self.dict_fnames_class[fname].items():
+                matrix[row, columns[label]] = count
+        return fnames, labels, matrix
+
     def get_balancing_stats(self, allowed_imbalance=0.00):
         """
         Understand the balancing flexibility and impact on the dataset.
 
+        Every class is reduced to at most (1 + allowed_imbalance) times the
+        smallest class, and no class below the smallest class, removing as
+        few files as the greedy solver finds. The result is deterministic,
+        and how far it can be from optimal is kept in self.solver_stats.
+
         :type allowed_imbalance: float
         :param allowed_imbalance: normalized acceptable imbalance.
         :returns: dictionary -- best achievable class distribution
@@ -109,63 +342,37 @@ class ClassBalancer:
         """
         balancing_base = min(
             self.class_distribution.items(), key=lambda x: x[1])
-        class_fnames_list = list(self.dict_fnames_class.items())
-        total_images = len(class_fnames_list)
-
-        balancing_classes = {}
-        balanced_classes = {}
-
-        allowed_thresh = 1+allowed_imbalance
-
-        for label, count in self.class_distribution.items():
-            if(count > allowed_thresh*balancing_base[1]):
-                balancing_classes[label] = count
-            else:
-                balanced_classes[label] = count
-
-        to_move = []
-        processed_list = []
-        while len(balancing_classes) != 0:
-            if len(class_fnames_list) != 0:
-                idx = random.randint(0,len(class_fnames_list)-1)
-                frame_data = class_fnames_list[idx]
-                class_fnames_list.pop(idx)
-                processed_list.append(frame_data[0])
-
-                if(
-                    len((
-                        set(balanced_classes.keys()) &
-                        set(frame_data[1].keys()))) == 0):
-                    to_update = {}
-
-                    deletable_frame = True
-                    for label, count in frame_data[1].items():
-                        if(balancing_classes[label] <= allowed_thresh *
-                                balancing_base[1]):
-                            balanced_classes[label] = balancing_classes[label]
-                            deletable_frame = False
-                            break
-                        else:
-                            to_update[label] = count
-
-                    if(deletable_frame):
-                        to_move.append(frame_data[0])
-                        for label, count in to_update.items():
-                            balancing_classes[label] -= count
-            else:
-                new_class_distribution = {}
-                new_class_distribution.update(balanced_classes)
-                new_class_distribution.update(balancing_classes)
-                print("BEST ACHIEVABLE BALANCE", new_class_distribution)
-                print('NOTE: %d/%d images from your dataset are required to be moved to achieve this balancing result.' % (len(to_move), total_images))
-                return new_class_distribution, to_move
-
-        # If successfully achieved required balancing
-        new_class_distribution = {}
-        new_class_distribution.update(balanced_classes)
-        new_class_distribution.update(balancing_classes)
-        print("SUCCESFULLY ACHIEVED REQUIRED BALANCE", new_class_distribution)
+        # the tolerance keeps e.g. 1.15 * 20 from flooring to 22
+        allowed_count = int(math.floor(
+            (1 + allowed_imbalance) * balancing_base[1] + 1e-9))
+
+        fnames, labels, matrix = self._count_matrix()
+        total_images = len(fnames)
+        counts = np.array(
+            [self.class_distribution[label] for label in labels],
+            dtype=np.int64)
+        rows, removed, lower_bound = _greedy_removal(
+            matrix, np.maximum(counts - allowed_count, 0),
+            counts - balancing_base[1])
+
+        to_move = [fnames[row] for row in rows]
+        remaining = counts - removed
+        new_class_distribution = dict(zip(labels, remaining.tolist()))
+        balanced = bool((remaining <= allowed_count).all())
+        self.solver_stats = {
+            'moved': len(to_move),
+            'lower_bound': lower_bound,
+            'gap': len(to_move) - lower_bound if balanced else None,
+            'balanced': balanced,
+        }
+
+        if balanced:
+            print("SUCCESFULLY ACHIEVED REQUIRED BALANCE", new_class_distribution)
+        else:
+            print("BEST ACHIEVABLE BALANCE", new_class_distribution)
         print('NOTE: %d/%d images from your dataset are required to be moved to achieve this balancing result.' % (len(to_move), total_images))
+        if balanced:
+            print('NOTE: any solution moves at least %d images, so this one is at most %d images from optimal.' % (lower_bound, self.solver_stats['gap']))
         return new_class_distribution, to_move
 
     def _create_required_dirs(self):
@@ -215,6 +422,12 @@ if __name__ == '__main__':
                 help='The directory to analyze; a folder (unzipped) with Annotation folder, in Pascal VOC, and a JPEGImages folder.')
     parser.add_argument('--allowed_imbalance', type=float, default=0.00)
     parser.add_argument('--partition', action='store_true')
+    parser.add_argument(
+                '--counts_only', action='store_true',
+                help='Only count the labels of each annotation, without building edgeiq predictions or importing edgeiq.')
+    parser.add_argument(
+                '--index', type=str,
+                help='Path of an SQLite file caching the label counts of each annotation by path, mtime and size, so reruns only parse new or changed annotations.')
     parser.add_argument(
                 '--output_dir', type=str,
                 help='The directory to store files on partioning. A holdout folder in input_dir will be created and used if not specified.')
@@ -222,7 +435,9 @@ if __name__ == '__main__':
     print(args)
 
     balancer = ClassBalancer()
-    class_distri = balancer.analyze_dataset(path=args.input_dir)
+    class_distri = balancer.analyze_dataset(
+        path=args.input_dir, index_path=args.index,
+        counts_only=args.counts_only)
     print("Initial Class Distribution: ", class_distri)
 
     new_class_distri, move_list = balancer.get_balancing_stats(
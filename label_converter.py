@@ -5,6 +5,9 @@ import csv
 import xml.etree.ElementTree as ET
 import argparse
 import shutil
+import collections
+import multiprocessing
+from zip_utils import copy_raw_member, is_annotation_member, write_member
 
 
 def get_all_file_paths(directory):
@@ -17,9 +20,218 @@ def get_all_file_paths(directory):
     return file_paths
 
 
-def main(input_dir, output_dir):
+def load_mapping(label_data):
+    """
+    :param label_data: list of (bad, good) label pairs
+    :return: dictionary of bad label to good label; if a bad label is
+        listed more than once, its first row wins
+    """
+    mapping = {}
+    for bad, good in label_data:
+        mapping.setdefault(bad, good)
+    return mapping
+
+
+def replace_labels(root, mapping):
+    """
+    Replaces the labels of an annotation in place, in a single pass over its
+    objects, and removes the objects mapped to 'omit'. Each label is mapped
+    once, so mappings are not chained.
+    :param root: the root element of the annotation
+    :param mapping: dictionary of bad label to good label
+    :return: collections.Counter of the (bad, good) replacements made
+    """
+    replaced = collections.Counter()
+    for obj in root.findall('object'):
+        omit = False
+        for name in obj.findall('name'):
+            good = mapping.get(name.text)
+            if good is None:
+                continue
+            replaced[(name.text, good)] += 1
+            name.text = good
+            omit = omit or good == 'omit'
+        if omit:
+            root.remove(obj)
+    return replaced
+
+
+# the state of each worker process, set by _init_worker
+_mapping = None
+_source = None
+
+
+def _init_worker(mapping, input_zip=None):
+    global _mapping, _source
+    _mapping = mapping
+    _source = zipfile.ZipFile(input_zip, 'r') if input_zip else None
+
+
+def _convert_file(annotation_file):
+    """
+    Relabels an extracted annotation file in place
+    :return: Counter of the replacements made
+    """
+    tree = ET.parse(annotation_file)
+    replaced = replace_labels(tree.getroot(), _mapping)
+    if replaced:
+        tree.write(annotation_file)
+    return replaced
+
+
+def _convert_member(annotation_member):
+    """
+    Relabels an annotation member of the input zip
+    :return: the member name, its new contents or None if it is unchanged,
+        and Counter of the replacements made
+    """
+    root = ET.fromstring(_source.read(annotation_member))
+    replaced = replace_labels(root, _mapping)
+    if not replaced:
+        return annotation_member, None, replaced
+    # the same bytes ElementTree.write produces for a parsed file
+    return annotation_member, ET.tostring(root, encoding='us-ascii'), replaced
+
+
+def count_labels(data):
+    """
+    Counts the object labels of an annotation, reading the same objects and
+    names that replace_labels maps
+    :param data: the annotation as bytes
+    :return: Counter of label to number of objects
+    """
+    # on annotation sized files, building the tree in C is faster than
+    # handling the events of a streaming parser in Python
+    return collections.Counter(
+        name.text for name in ET.fromstring(data).iterfind('object/name'))
+
+
+def _count_member(annotation_member):
+    return count_labels(_source.read(annotation_member))
+
+
+def scan(input_dir, mapping, workers=1):
+    """
+    Reports what relabeling a zipped dataset would do, reading only its
+    annotation members and writing nothing
+    :param input_dir: path of the input zip
+    :param mapping: dictionary of bad label to good label
+    :param workers: the number of worker processes parsing annotations
+    :return: dictionary of the files scanned and affected, the label counts
+        before and after mapping, the objects per mapping row, and the
+        labels no row maps
+    """
+    with zipfile.ZipFile(input_dir, 'r') as source:
+        annotation_members = [
+            name for name in source.namelist()
+            if is_annotation_member(name)]
+
+    before = collections.Counter()
+    affected = 0
+    for labels in _map(
+            _count_member, annotation_members, workers, (mapping, input_dir)):
+        before.update(labels)
+        affected += any(label in mapping for label in labels)
+
+    after = collections.Counter()
+    for label, count in before.items():
+        good = mapping.get(label, label)
+        if good != 'omit':
+            after[good] += count
+    return {
+        'files': len(annotation_members),
+        'affected_files': affected,
+        'before': before,
+        'after': after,
+        'omitted': sum(
+            count for label, count in before.items()
+            if mapping.get(label) == 'omit'),
+        'rows': [
+            (bad, good, before.get(bad, 0)) for bad, good in mapping.items()],
+        'unmapped': collections.Counter({
+            label: count for label, count in before.items()
+            if label not in mapping}),
+    }
+
+
+def print_scan(result):
+    print("{} annotation files, {} would change.".format(
+        result['files'], result['affected_files']))
+    print("\tLabels before mapping:")
+    for label, count in result['before'].most_common():
+        print("\t\t{}: {}".format(label, count))
+    print("\tLabels after mapping:")
+    for label, count in result['after'].most_common():
+        print("\t\t{}: {}".format(label, count))
+    print("\tObjects omitted: {}".format(result['omitted']))
+    print("\tMapping rows:")
+    for bad, good, count in result['rows']:
+        print("\t\t{} -> {}: {}{}".format(
+            bad, good, count, "" if count else " (never used)"))
+    print("\tUnmapped labels:")
+    for label, count in result['unmapped'].most_common():
+        print("\t\t{}: {}".format(label, count))
+
+
+def _map(function, items, workers, initargs):
+    """
+    Maps a function over items in order, across a pool of worker processes
+    when there is more than one worker
+    """
+    if workers > 1:
+        with multiprocessing.Pool(
+                workers, initializer=_init_worker, initargs=initargs) as pool:
+            yield from pool.imap(function, items, chunksize=64)
+    else:
+        _init_worker(*initargs)
+        yield from map(function, items)
+
+
+def _count(replaced, bad_labels, good_labels):
+    for (bad, good), count in replaced.items():
+        bad_labels[bad] += count
+        good_labels[good] += count
+
+
+def convert_stream(
+        input_dir, output_zip, mapping, bad_labels, good_labels, workers=1):
+    """
+    Streams the input zip into the output zip, only rewriting the annotation
+    members whose labels change. Every other member, such as the images, is
+    copied as raw compressed data without being decompressed or
+    recompressed. The zip is written under a temporary name and only
+    renamed once complete.
+    :param input_dir: path of the input zip
+    :param output_zip: path of the output zip
+    :param workers: the number of worker processes parsing annotations
+    :return: the number of annotation members rewritten
+    """
+    partial_zip = "{}.partial".format(output_zip)
+    rewritten = 0
+    with zipfile.ZipFile(input_dir, 'r') as source, \
+            zipfile.ZipFile(partial_zip, 'w') as target:
+        annotation_members = [
+            info.filename for info in source.infolist()
+            if is_annotation_member(info.filename)]
+        for info in source.infolist():
+            if not is_annotation_member(info.filename):
+                copy_raw_member(source, target, info)
+
+        for member, data, replaced in _map(
+                _convert_member, annotation_members, workers,
+                (mapping, input_dir)):
+            _count(replaced, bad_labels, good_labels)
+            if data is None:
+                copy_raw_member(source, target, source.getinfo(member))
+            else:
+                write_member(target, member, data)
+                rewritten += 1
+    os.replace(partial_zip, output_zip)
+    return rewritten
+
+
+def main(input_dir, output_dir, stream=False, workers=1, dry_run=False):
     # Check for invalid input directory
-    list = [layerName[0] - 1] for layerName in mynetwork.getUnconnectedOutLayers() lang:Python
     if not os.path.exists(input_dir):
         input_dir = os.path.join(os.getcwd(), input_dir)
         if not os.path.exists(input_dir):
@@ -29,19 +241,39 @@ def main(input_dir, output_dir):
         input_suffix_ind = input_dir.rfind(".")
         output_dir = "{}_renamed".format(input_dir[:input_suffix_ind])
 
-    print("Unzipping files...")
-    if zipfile.is_zipfile(input_dir):
-        print("Extracting " + input_dir + "...")
-        with zipfile.ZipFile(input_dir, 'r') as zip:
-            zip.extractall(output_dir)
-
     label_mappings = 'label_mappings.csv'
     with open(label_mappings) as f:
         label_data = [tuple(line) for line in csv.reader(f)]
+    mapping = load_mapping(label_data)
+
+    if dry_run:
+        if not zipfile.is_zipfile(input_dir):
+            raise RuntimeError("A dry run requires a zip input")
+        print("Scanning {}...".format(input_dir))
+        print_scan(scan(input_dir, mapping, workers))
+        return
 
     bad_labels = {bad: 0 for bad, _ in label_data}
     good_labels = {good: 0 for _, good in label_data}
 
+    if stream:
+        if not zipfile.is_zipfile(input_dir):
+            raise RuntimeError("Streaming requires a zip input")
+        print("Streaming {} to {}.zip...".format(input_dir, output_dir))
+        rewritten = convert_stream(
+            input_dir, "{}.zip".format(output_dir), mapping, bad_labels,
+            good_labels, workers)
+        print("Relabeled {} annotation files.".format(rewritten))
+        print_stats(bad_labels, good_labels)
+        print("Done.")
+        return
+
+    print("Unzipping files...")
+    if zipfile.is_zipfile(input_dir):
+        print("Extracting " + input_dir + "...")
+        with zipfile.ZipFile(input_dir, 'r') as zip:
+            zip.extractall(output_dir)
+
     # create a new directory for the annotations at the level of the
     # folder that contains the annotation sets
     annotation_path = os.path.join(output_dir, "Annotations")
@@ -51,27 +283,26 @@ def main(input_dir, output_dir):
     # get all annotation files for a particular annotation task
     annotation_files = get_all_file_paths(annotation_path)
 
-    # read in annotation data
-    for annotation_file in annotation_files:
-        print(annotation_file)
-        tree = ET.parse(annotation_file)
-        root = tree.getroot()
+    # relabel the annotation files across the workers, merging their stats
+    rewritten = 0
+    for replaced in _map(
+            _convert_file, annotation_files, workers, (mapping,)):
+        _count(replaced, bad_labels, good_labels)
+        rewritten += bool(replaced)
 
-        # replace labels
-        for bad, good in label_data:
-            for obj in root.findall('object'):
-                for name in obj.findall('name'):
-                    if name.text == bad:
-                        bad_labels[bad] += 1
-                        good_labels[good] += 1
-                        name.text = good
+    print("Program Finished")
+    print("Relabeled {} of {} annotation files.".format(
+        rewritten, len(annotation_files)))
+    print_stats(bad_labels, good_labels)
 
-                        if good == 'omit':
-                            root.remove(obj)
+    print("Zipping files...")
+    shutil.make_archive(
+        "{}".format(output_dir), "zip", output_dir)
+    shutil.rmtree(output_dir)
+    print("Done.")
 
-        tree.write(annotation_file)
 
-    print("Program Finished")
+def print_stats(bad_labels, good_labels):
     print("Label Stats:")
     print("___________________")
     print("\tOriginal Labels:")
@@ -82,12 +313,6 @@ def main(input_dir, output_dir):
     for label in good_labels:
         print("\t\t" + str(label) + ": " + str(good_labels[label]))
 
-    print("Zipping files...")
-    shutil.make_archive(
-        "{}".format(output_dir), "zip", output_dir)
-    shutil.rmtree(output_dir)
-    print("Done.")
-
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -98,7 +323,18 @@ if __name__ == "__main__":
     parser.add_argument(
                 '--output_dir', type=str, default="",
                 help='The directory to save the updated files to.')
+    parser.add_argument(
+                '--stream', action='store_true',
+                help='Stream the input zip straight into the output zip, only rewriting the annotations and copying the images as they are.')
+    parser.add_argument(
+                '--workers', type=int, default=1,
+                help='The number of worker processes relabeling annotations.')
+    parser.add_argument(
+                '--dry_run', '--dry-run', '--stats', action='store_true',
+                dest='dry_run',
+                help='Only report the label counts before and after mapping, the mapping rows used and the unmapped labels, without writing anything.')
 
     args = parser.parse_args()
 
-    main(input_dir=args.input_dir, output_dir=args.output_dir)
+    main(input_dir=args.input_dir, output_dir=args.output_dir,
+         stream=args.stream, workers=args.workers, dry_run=args.dry_run)
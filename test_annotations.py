@@ -3,12 +3,16 @@ import imgaug.augmenters as iaa
 from imgaug.augmentables.bbs import BoundingBox, BoundingBoxesOnImage
 import cv2
 import os
-import zipfile
-import copy as cp
 import xml.etree.ElementTree as ET
 import argparse
 import time
-import shutil
+import functools
+import random
+import collections
+import multiprocessing
+import numpy as np
+from zip_utils import DatasetReader, image_member
+from validate_annotations import _number
 
 
 def get_all_file_paths(directory):
@@ -24,33 +28,341 @@ def get_all_file_paths(directory):
     return file_paths
 
 
-def get_updated_annotation(input_annotation, bounding_boxes):
+# the reduced decoding flag of each preview scale
+PREVIEW_SCALES = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+# the dataset reader of each worker process, set by _init_worker
+_reader = None
+
+
+def _init_worker(input_dir):
+    global _reader
+    _reader = DatasetReader(input_dir)
+
+
+def read_annotation(annotation_member):
+    """
+    Reads an annotation straight from the dataset into memory
+    :param annotation_member: member name of the annotation
+    :return: the annotation root element, the image name and the image
+        member name
+    """
+    # read in the annotation for the image
+    root = ET.fromstring(_reader.read(annotation_member))
+
+    # the image lives in the JPEGImages folder next to Annotations
+    image_name = root.find('filename').text
+    return root, image_name, image_member(annotation_member, image_name)
+
+
+def decode_image(image_member, preview_scale=1):
+    """
+    Decodes an image straight from the dataset into memory
+    :param image_member: member name of the image
+    :param preview_scale: decode the image at 1/preview_scale of its size,
+        one of PREVIEW_SCALES
+    :return: the image
+    """
+    # JPEGs are downscaled while decoding, in the DCT domain, so the full
+    # size image is never held in memory
+    image = cv2.imdecode(
+        np.frombuffer(_reader.read(image_member), np.uint8),
+        PREVIEW_SCALES[preview_scale])
+
+    if image is None:
+        raise RuntimeError("Invalid image {}".format(image_member))
+    return image
+
+
+def load_annotation(annotation_member, preview_scale=1):
+    """
+    Reads an annotation and decodes its image, both straight from the
+    dataset into memory
+    :param annotation_member: member name of the annotation
+    :param preview_scale: decode the image at 1/preview_scale of its size,
+        one of PREVIEW_SCALES
+    :return: the annotation root element, the image name and the image
+    """
+    root, image_name, image_member = read_annotation(annotation_member)
+    return root, image_name, decode_image(image_member, preview_scale)
+
+
+def draw_boxes(root, image, scale=1.0, thickness=3, font_scale=0.4):
+    """
+    Draws every box and label of an annotation over its image, in place
+    :param root: the annotation root element
+    :param image: the image, possibly resized by scale
+    :param scale: the factor the image was resized by
+    """
+    for obj in root.findall('object'):
+        label = obj.find('name').text
+        for box in obj.findall('bndbox'):
+            x1 = int(float(box.find('xmin').text) * scale)
+            x2 = int(float(box.find('xmax').text) * scale)
+            y1 = int(float(box.find('ymin').text) * scale)
+            y2 = int(float(box.find('ymax').text) * scale)
+
+            cv2.rectangle(image, (x1, y1), (x2, y2), (255, 0, 0), thickness)
+            cv2.putText(
+                image, label, (x2 + 5, y2 - 5), cv2.FONT_HERSHEY_SIMPLEX,
+                font_scale, (255, 0, 0), 1)
+    return image
+
+
+def render_annotation(
+        annotation_member, test_image_directory, preview_scale=1):
+    """
+    Draws every box and label of an annotation over its image, decoding and
+    encoding the image once
+    :param annotation_member: member name of the annotation
+    :param test_image_directory: the directory to write the test image to
+    :param preview_scale: write the test image at 1/preview_scale of its
+        size, one of PREVIEW_SCALES
+    :return: the path of the test image
+    """
+    root, image_name, image = load_annotation(
+        annotation_member, preview_scale)
+    draw_boxes(root, image, 1.0 / preview_scale)
+
+    image_suffix_ind = image_name.rfind(".")
+    i = image_name[:image_suffix_ind]
+    i_suffix = image_name[image_suffix_ind:]
+    new_image_path = "{}{}{}{}{}".format(
+        test_image_directory, os.sep, i, "_test_box", i_suffix)
+    try:
+        cv2.imwrite(new_image_path, image)
+    except cv2.error:
+        print("ERROR")
+        print(new_image_path)
+    return new_image_path
+
+
+def _tile_preview_scale(root, tile_size):
+    """
+    :return: the largest of PREVIEW_SCALES that still decodes the image of
+        an annotation at least as large as a mosaic tile, going by the
+        annotation's size element
+    """
+    sizes = [_number(root, tag) for tag in ('size/width', 'size/height')]
+    longest = max([0] + [size for size in sizes if not np.isnan(size)])
+    return max(
+        scale for scale in PREVIEW_SCALES
+        if scale == 1 or longest / scale >= tile_size)
+
+
+def render_tile(annotation_member, tile_size, preview_scale=None):
+    """
+    Downsizes an image to fit a mosaic tile, then draws its boxes and labels
+    :param annotation_member: member name of the annotation
+    :param tile_size: the width and height of the tile
+    :param preview_scale: decode the image at 1/preview_scale of its size,
+        one of PREVIEW_SCALES; by default the largest that still fills the
+        tile
+    :return: the image name and the tile image
+    """
+    root, image_name, image_member = read_annotation(annotation_member)
+    if preview_scale is None:
+        preview_scale = _tile_preview_scale(root, tile_size)
+    image = decode_image(image_member, preview_scale)
+    height, width = image.shape[0:2]
+    scale = min(1.0, float(tile_size) / max(height, width))
+    if scale < 1.0:
+        image = cv2.resize(
+            image, (max(1, int(width * scale)), max(1, int(height * scale))),
+            interpolation=cv2.INTER_AREA)
+    # boxes are drawn after resizing, so the lines stay visible
+    return image_name, draw_boxes(
+        root, image, scale / preview_scale, thickness=1, font_scale=0.3)
+
+
+class MosaicWriter:
     """
-    Function to update the annotation's bounding boxes
-    :param input_annotation: the original annotation read in
-    :param bounding_boxes: the augmented bounding boxes
-    :return: the updated annotation in xml format
+    Tiles rendered images into grid sheets, each tile captioned with its
+    file name
     """
-    annotation = cp.deepcopy(input_annotation)
-    count = 0
-    root = annotation.getroot()
+    CAPTION_HEIGHT = 16
+
+    def __init__(self, directory, rows, cols, tile_size):
+        self.directory = directory
+        self.rows = rows
+        self.cols = cols
+        self.tile_size = tile_size
+        self.tiles = []
+        self.sheets = []
+
+    def add(self, image_name, tile):
+        self.tiles.append((image_name, tile))
+        if len(self.tiles) == self.rows * self.cols:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the pending tiles as a sheet
+        """
+        if not self.tiles:
+            return
+        cell_height = self.tile_size + self.CAPTION_HEIGHT
+        rows = (len(self.tiles) + self.cols - 1) // self.cols
+        sheet = np.zeros(
+            (rows * cell_height, self.cols * self.tile_size, 3), np.uint8)
+        # roughly the characters of the caption font that fit in a tile
+        max_chars = max(4, self.tile_size // 6)
+        for index, (image_name, tile) in enumerate(self.tiles):
+            row, col = divmod(index, self.cols)
+            y, x = row * cell_height, col * self.tile_size
+            height, width = tile.shape[0:2]
+            sheet[y:y + height, x:x + width] = tile
+            caption = image_name if len(image_name) <= max_chars \
+                else "..." + image_name[3 - max_chars:]
+            cv2.putText(
+                sheet, caption, (x + 2, y + cell_height - 4),
+                cv2.FONT_HERSHEY_SIMPLEX, 0.35, (255, 255, 255), 1)
+
+        sheet_path = os.path.join(
+            self.directory, "mosaic_{:04d}.jpg".format(len(self.sheets) + 1))
+        cv2.imwrite(sheet_path, sheet)
+        self.sheets.append(sheet_path)
+        self.tiles = []
+        return sheet_path
+
+
+STRATEGIES = ('every_nth', 'random', 'per_class', 'small_boxes', 'edge_boxes')
+
+# boxes under 32x32 pixels, the COCO definition of small objects
+SMALL_BOX_AREA = 32 * 32
+# boxes within this many pixels of the image border count as edge boxes
+EDGE_MARGIN = 2
+
 
+def index_annotation(annotation_member):
+    """
+    Summarizes an annotation for choosing the sample, reading only its XML
+    :param annotation_member: member name of the annotation
+    :return: tuple of the member name, its labels, and its numbers of small
+        boxes and of boxes touching the image border. The labels are None
+        when the annotation can't be rendered: its XML doesn't parse, it
+        names no image, or a box coordinate is missing or not a number.
+    """
+    unusable = annotation_member, None, 0, 0
+    try:
+        root = ET.fromstring(_reader.read(annotation_member))
+    except ET.ParseError:
+        return unusable
+    if not root.findtext('filename'):
+        return unusable
+    # the image size is optional in Pascal VOC, and unknown when unusable
+    width, height = [
+        0 if np.isnan(value) else value
+        for value in (_number(root, 'size/width'),
+                      _number(root, 'size/height'))]
+    labels = []
+    small = edge = 0
     for obj in root.findall('object'):
+        label = obj.findtext('name')
         for box in obj.findall('bndbox'):
-            box.find('xmin').text = str(bounding_boxes[count].x1)
-            box.find('xmax').text = str(bounding_boxes[count].x2)
-            box.find('ymin').text = str(bounding_boxes[count].y1)
-            box.find('ymax').text = str(bounding_boxes[count].y2)
-            count += 1
-    return annotation
+            labels.append(label)
+            x1, y1, x2, y2 = [
+                _number(box, tag) for tag in ('xmin', 'ymin', 'xmax', 'ymax')]
+            if np.isnan([x1, y1, x2, y2]).any():
+                return unusable
+            small += (x2 - x1) * (y2 - y1) < SMALL_BOX_AREA
+            edge += width > 0 and height > 0 and (
+                min(x1, y1) <= EDGE_MARGIN or x2 >= width - EDGE_MARGIN or
+                y2 >= height - EDGE_MARGIN)
+    return annotation_member, labels, small, edge
+
+
+def select_sample(index, strategy, sample, seed=None, per_class=5):
+    """
+    Chooses the annotations to test
+    :param index: list of index_annotation tuples, in member order
+    :param strategy: one of STRATEGIES. 'every_nth' takes every sample-th
+        annotation, and 'random' a uniform random 1 in sample. 'per_class'
+        takes at least per_class annotations of every label, rarest labels
+        first. 'small_boxes' and 'edge_boxes' draw 1 in sample at random,
+        weighted by the number of small or edge boxes.
+    :param sample: the sample rate
+    :param seed: seed of the random strategies
+    :param per_class: the number of annotations per label for 'per_class'
+    :return: the chosen member names, in member order
+    """
+    if strategy not in STRATEGIES:
+        raise RuntimeError("Unknown sampling strategy {}".format(strategy))
+    members = [entry[0] for entry in index]
+    if strategy == 'every_nth':
+        return members[::sample]
+
+    rng = random.Random(seed)
+    count = max(1, len(members) // sample)
+    if strategy == 'random':
+        chosen = rng.sample(range(len(members)), count)
+    elif strategy == 'per_class':
+        by_label = collections.defaultdict(list)
+        for position, (_, labels, _, _) in enumerate(index):
+            for label in set(labels):
+                by_label[label].append(position)
+        chosen = set()
+        for label in sorted(by_label, key=lambda l: (len(by_label[l]), l)):
+            positions = by_label[label]
+            # files already chosen for rarer labels count towards the quota
+            have = sum(position in chosen for position in positions)
+            candidates = [p for p in positions if p not in chosen]
+            rng.shuffle(candidates)
+            chosen.update(candidates[:max(0, per_class - have)])
+    else:
+        column = 2 if strategy == 'small_boxes' else 3
+        # weighted sampling without replacement: the largest u ** (1 / w)
+        keys = [
+            rng.random() ** (1.0 / (1 + entry[column])) for entry in index]
+        chosen = sorted(
+            range(len(members)), key=lambda p: keys[p], reverse=True)[:count]
+    return [members[position] for position in sorted(chosen)]
+
+
+def _parse_grid(grid):
+    """
+    Parses a mosaic grid given as "<rows>x<cols>"
+    """
+    try:
+        rows, cols = [int(value) for value in grid.lower().split('x')]
+    except ValueError:
+        raise RuntimeError("Invalid mosaic grid {}, expected e.g. 6x6".format(
+            grid))
+    if rows < 1 or cols < 1:
+        raise RuntimeError("Invalid mosaic grid {}".format(grid))
+    return rows, cols
+
+
+def _imap(function, items, workers, input_dir, chunksize=8):
+    """
+    Maps a function over items in order, across a pool of worker processes
+    when there is more than one worker, each reading the dataset itself
+    """
+    if workers > 1:
+        with multiprocessing.Pool(
+                workers, initializer=_init_worker,
+                initargs=(input_dir,)) as pool:
+            yield from pool.imap(function, items, chunksize=chunksize)
+    else:
+        _init_worker(input_dir)
+        yield from map(function, items)
 
 
-def main(input_dir, output_dir, sample):
+def main(input_dir, output_dir, sample, workers=1, mosaic=None,
+         tile_size=256, strategy='every_nth', seed=None, per_class=5,
+         preview_scale=None):
 
     if not os.path.exists(input_dir):
         input_dir = os.path.join(os.getcwd(), input_dir)
         if not os.path.exists(input_dir):
             raise RuntimeError("Invalid input directory")
+    if preview_scale is not None and preview_scale not in PREVIEW_SCALES:
+        raise RuntimeError("Invalid preview scale {}".format(preview_scale))
 
     res_date = time.strftime('%Y.%m.%d')
     res_time = time.strftime('%H.%M.%S')
@@ -66,20 +378,12 @@ def main(input_dir, output_dir, sample):
                 os.path.join(os.getcwd(), output_dir, ".zip")):
         raise RuntimeError("Output directory already exists.")
 
-    print("Unzipping files...")
-    if zipfile.is_zipfile(input_dir):
-        print("Extracting " + input_dir + "...")
-        with zipfile.ZipFile(input_dir, 'r') as zip:
-            zip.extractall(output_dir)
-    # create the new directories for Annotations and JPEGImages
-    new_annotation_path = os.path.join(output_dir, "Annotations")
-    new_image_directory = os.path.join(output_dir, 'JPEGImages')
-
     test_image_directory = os.path.join(output_dir, 'TestImages')
-    os.mkdir(test_image_directory)
+    os.makedirs(test_image_directory)
 
-    # get all annotation files for a particular annotation task
-    annotation_files = get_all_file_paths(new_annotation_path)
+    # list the annotations without extracting anything; only the sampled
+    # annotations and images are ever decompressed
+    annotation_files = DatasetReader(input_dir).annotation_members()
 
     # get all annotation files for a particular annotation task
     if len(annotation_files) == 0:
@@ -88,72 +392,50 @@ def main(input_dir, output_dir, sample):
 
     sample = sample if len(annotation_files) > sample else len(
         annotation_files)
+    if strategy == 'every_nth':
+        sampled_files = select_sample(
+            [(member,) for member in annotation_files], strategy, sample)
+    else:
+        # a pre-pass over the XML alone, so choosing doesn't decode images
+        print("Indexing annotations...")
+        index = list(_imap(
+            index_annotation, annotation_files, workers, input_dir,
+            chunksize=64))
+        unusable = [entry[0] for entry in index if entry[1] is None]
+        if unusable:
+            print("Skipping {} annotations that can't be rendered:".format(
+                len(unusable)))
+            for member in unusable:
+                print("\t{}".format(member))
+            index = [entry for entry in index if entry[1] is not None]
+        if not index:
+            raise RuntimeError("No annotation can be rendered.")
+        sampled_files = select_sample(
+            index, strategy, sample, seed, per_class)
     print("{} total annotation pairs present, testing {} pairs.".format(
-        len(annotation_files), int(len(annotation_files)/sample)))
+        len(annotation_files), len(sampled_files)))
 
     print("Testing images...")
-    count = 0
-    # read in annotation data one file at a time
-    for annotation_file in annotation_files:
-        if count % sample == 0:
-            print(annotation_file)
-            # read in the annotation for the image
-            tree = ET.parse(annotation_file)
-            root = tree.getroot()
-
-            # make the new image path and name
-            image_name = root.find('filename').text
-            original_image_path = os.path.join(new_image_directory, image_name)
-
-            image = cv2.imread(original_image_path)
-
-            if image is None:
-                raise RuntimeError("Invalid image path {}".format(
-                    original_image_path))
-
-            for obj in root.findall('object'):
-                label = obj.find('name').text
-                for box in obj.findall('bndbox'):
-                    x1 = int(float(box.find('xmin').text))
-                    x2 = int(float(box.find('xmax').text))
-                    y1 = int(float(box.find('ymin').text))
-                    y2 = int(float(box.find('ymax').text))
-
-                    start = (x1, y1)
-                    end = (x2, y2)
-
-                    if start is None or end is None:
-                        raise RuntimeError(
-                            "Invalid annotation box for file {}".format(
-                                annotation_file))
-
-                    else:
-                        image_suffix_ind = image_name.rfind(".")
-                        i = image_name[:image_suffix_ind]
-                        i_suffix = image_name[image_suffix_ind:]
-                        new_image_path = "{}{}{}{}{}".format(
-                            test_image_directory,
-                            os.sep,
-                            i,
-                            "_test_box",
-                            i_suffix)
-                        new_image = cv2.rectangle(
-                            image, (x1, y1), (x2, y2), (255, 0, 0), 3)
-                        new_image = cv2.putText(
-                            new_image, label, (x2 + 5, y2 - 5),
-                            cv2.FONT_HERSHEY_SIMPLEX,
-                            0.4, (255, 0, 0), 1)
-                        try:
-                            cv2.imwrite(new_image_path, new_image)
-                        except cv2.error:
-                            print("ERROR")
-                            print(new_image_path)
-
-        count += 1
-    shutil.rmtree(new_annotation_path)
-    shutil.rmtree(new_image_directory)
+    if mosaic:
+        rows, cols = _parse_grid(mosaic)
+        writer = MosaicWriter(test_image_directory, rows, cols, tile_size)
+        render = functools.partial(
+            render_tile, tile_size=tile_size, preview_scale=preview_scale)
+        for image_name, tile in _imap(
+                render, sampled_files, workers, input_dir):
+            writer.add(image_name, tile)
+        writer.flush()
+        print("Wrote {} mosaic sheets.".format(len(writer.sheets)))
+    else:
+        render = functools.partial(
+            render_annotation, test_image_directory=test_image_directory,
+            preview_scale=preview_scale or 1)
+        for test_image_path in _imap(
+                render, sampled_files, workers, input_dir):
+            print(test_image_path)
+
     print("Tested {} images. Available in {}.".format(
-        int(len(annotation_files)/sample), new_image_directory))
+        len(sampled_files), test_image_directory))
     print("Done.")
 
 
@@ -170,8 +452,33 @@ if __name__ == "__main__":
         parser.add_argument(
                 '--sample', type=int, default=1,
                 help='The sample rate to test annotations.')
+        parser.add_argument(
+                '--workers', type=int, default=1,
+                help='The number of worker processes rendering images.')
+        parser.add_argument(
+                '--mosaic', type=str,
+                help='Tile the tested images into contact sheets of the given grid, e.g. 6x6, instead of writing each image.')
+        parser.add_argument(
+                '--tile_size', type=int, default=256,
+                help='The size in pixels each image is downsized to in a mosaic.')
+
+        parser.add_argument(
+                '--strategy', type=str, choices=STRATEGIES,
+                default='every_nth',
+                help='How to choose the tested images: every Nth annotation, uniformly at random, at least --per_class images of every label, or at random weighted towards images with small or edge boxes.')
+        parser.add_argument(
+                '--seed', type=int,
+                help='Seed for the random sampling strategies.')
+        parser.add_argument(
+                '--per_class', type=int, default=5,
+                help='The number of images per label for the per_class strategy.')
+        parser.add_argument(
+                '--preview_scale', type=int, choices=sorted(PREVIEW_SCALES),
+                help='Decode the tested images at 1/N of their size, with the boxes scaled to match. Mosaics pick the largest scale that still fills a tile if not specified.')
 
         args = parser.parse_args()
-        main(args.input_dir, args.output_dir, args.sample)
+        main(args.input_dir, args.output_dir, args.sample, args.workers,
+             args.mosaic, args.tile_size, args.strategy, args.seed,
+             args.per_class, args.preview_scale)
     except RuntimeError as err:
         print(err)
@@ -0,0 +1,294 @@
+import argparse
+import collections
+import json
+import multiprocessing
+import os
+import struct
+import time
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+from zip_utils import DatasetReader, image_member
+
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# start of frame markers, the only JPEG segments holding the image size
+_JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# markers without a length field
+_JPEG_STANDALONE_MARKERS = set(range(0xD0, 0xDA)) | {0x01}
+
+BOX_ISSUES = ('inverted', 'degenerate', 'out_of_bounds')
+
+
+def read_image_size(f):
+    """
+    Reads the dimensions of a JPEG or PNG image from its header, without
+    decoding any pixels
+    :param f: binary file object positioned at the start of the image
+    :return: (width, height), or None if the format is not recognized or
+        the header is truncated
+    """
+    start = f.read(2)
+    if start == _PNG_SIGNATURE[:2]:
+        header = start + f.read(22)
+        if len(header) < 24 or header[:8] != _PNG_SIGNATURE or \
+                header[12:16] != b'IHDR':
+            return None
+        return struct.unpack('>II', header[16:24])
+    if start != b'\xff\xd8':
+        return None
+
+    while True:
+        byte = f.read(1)
+        # skip to the next marker, and over any fill bytes
+        while byte and byte != b'\xff':
+            byte = f.read(1)
+        while byte == b'\xff':
+            byte = f.read(1)
+        if not byte:
+            return None
+        marker = byte[0]
+        if marker in _JPEG_STANDALONE_MARKERS:
+            continue
+        length = f.read(2)
+        if len(length) < 2:
+            return None
+        length = struct.unpack('>H', length)[0]
+        if marker in _JPEG_SOF_MARKERS:
+            frame = f.read(5)
+            if len(frame) < 5:
+                return None
+            height, width = struct.unpack('>HH', frame[1:5])
+            return width, height
+        if len(f.read(length - 2)) < length - 2:
+            return None
+
+
+# the dataset reader of each worker process, set by _init_worker
+_reader = None
+
+
+def _init_worker(input_dir):
+    global _reader
+    _reader = DatasetReader(input_dir)
+
+
+def _number(element, tag):
+    """
+    :return: the value of a child element, or NaN if it is missing, empty,
+        not a number or not finite
+    """
+    try:
+        value = float(element.findtext(tag))
+    except (TypeError, ValueError):
+        return np.nan
+    return value if np.isfinite(value) else np.nan
+
+
+def read_annotation(annotation_member):
+    """
+    Reads what validation needs from an annotation and its image header
+    :param annotation_member: member name of the annotation
+    :return: dictionary of the source, image member, XML size, header size,
+        (N, 4) float64 box array, labels and file level issues
+    """
+    record = {
+        'source': annotation_member, 'image': None, 'xml_size': None,
+        'image_size': None, 'boxes': np.zeros((0, 4)), 'labels': [],
+        'issues': [],
+    }
+    try:
+        with _reader.open(annotation_member) as f:
+            root = ET.parse(f).getroot()
+    except ET.ParseError as err:
+        record['issues'].append(('invalid_xml', str(err)))
+        return record
+
+    image_name = root.findtext('filename')
+    if not image_name:
+        record['issues'].append(('missing_filename', None))
+        return record
+    record['image'] = image_member(annotation_member, image_name)
+
+    size = root.find('size')
+    if size is None:
+        record['issues'].append(('missing_size', None))
+    else:
+        xml_size = (_number(size, 'width'), _number(size, 'height'))
+        # not compared against the image, so no NaN reaches the report
+        if np.isnan(xml_size).any() or min(xml_size) <= 0:
+            record['issues'].append(('invalid_size', {
+                tag: size.findtext(tag) for tag in ('width', 'height')}))
+        else:
+            record['xml_size'] = xml_size
+
+    boxes = []
+    for obj in root.findall('object'):
+        label = obj.findtext('name')
+        for box in obj.findall('bndbox'):
+            boxes.append([
+                _number(box, tag) for tag in ('xmin', 'ymin', 'xmax', 'ymax')])
+            record['labels'].append(label)
+    record['boxes'] = np.array(boxes, dtype=np.float64).reshape(-1, 4)
+
+    try:
+        with _reader.open(record['image']) as f:
+            record['image_size'] = read_image_size(f)
+        if record['image_size'] is None:
+            record['issues'].append(('unreadable_image_header', None))
+    except RuntimeError:
+        record['issues'].append(('missing_image', record['image']))
+    return record
+
+
+def check_boxes(records, tolerance=0.0, min_size=1.0):
+    """
+    Checks every box of the dataset at once
+    :param records: list of read_annotation records
+    :param tolerance: pixels a box may extend past the image border
+    :param min_size: the smallest valid box width and height
+    :return: dictionary of issue name to the (record index, box index)
+        pairs with that issue
+    """
+    counts = [len(record['boxes']) for record in records]
+    if not sum(counts):
+        return {issue: [] for issue in BOX_ISSUES}
+    boxes = np.concatenate([record['boxes'] for record in records])
+    file_index = np.repeat(np.arange(len(records)), counts)
+    box_index = np.concatenate([np.arange(count) for count in counts])
+
+    # the real image size where the header was read, else the XML size
+    sizes = np.array([
+        record['image_size'] or record['xml_size'] or (np.nan, np.nan)
+        for record in records], dtype=np.float64)[file_index]
+
+    x1, y1, x2, y2 = boxes.T
+    box_width, box_height = x2 - x1, y2 - y1
+    with np.errstate(invalid='ignore'):
+        inverted = (box_width < 0) | (box_height < 0) | \
+            np.isnan(boxes).any(axis=1)
+        degenerate = ~inverted & (
+            (box_width < min_size) | (box_height < min_size))
+        # every corner, so inverted boxes are bounds checked too
+        xs, ys = boxes[:, 0::2], boxes[:, 1::2]
+        out_of_bounds = (xs < -tolerance).any(axis=1) | \
+            (ys < -tolerance).any(axis=1) | \
+            (xs > sizes[:, :1] + tolerance).any(axis=1) | \
+            (ys > sizes[:, 1:] + tolerance).any(axis=1)
+
+    return {
+        issue: list(zip(file_index[mask].tolist(), box_index[mask].tolist()))
+        for issue, mask in (
+            ('inverted', inverted), ('degenerate', degenerate),
+            ('out_of_bounds', out_of_bounds))}
+
+
+def validate(input_dir, workers=1, tolerance=0.0, min_size=1.0):
+    """
+    Validates every annotation of a dataset against its image
+    :param input_dir: a zipped dataset or an extracted dataset folder
+    :param workers: the number of worker processes reading annotations
+    :param tolerance: pixels a box may extend past the image border
+    :param min_size: the smallest valid box width and height
+    :return: the report, as a JSON serializable dictionary
+    """
+    start = time.perf_counter()
+    annotation_members = DatasetReader(input_dir).annotation_members()
+    if workers > 1:
+        with multiprocessing.Pool(
+                workers, initializer=_init_worker,
+                initargs=(input_dir,)) as pool:
+            records = pool.map(
+                read_annotation, annotation_members, chunksize=64)
+    else:
+        _init_worker(input_dir)
+        records = [read_annotation(member) for member in annotation_members]
+
+    issues = []
+    for record in records:
+        for issue, detail in record['issues']:
+            issues.append({
+                'source': record['source'], 'issue': issue,
+                'detail': detail})
+        if record['image_size'] is not None and \
+                record['xml_size'] is not None and \
+                tuple(record['image_size']) != tuple(record['xml_size']):
+            issues.append({
+                'source': record['source'], 'issue': 'size_mismatch',
+                'detail': {
+                    'xml': list(record['xml_size']),
+                    'image': list(record['image_size'])}})
+
+    for issue, pairs in check_boxes(records, tolerance, min_size).items():
+        for file_index, box_index in pairs:
+            record = records[file_index]
+            issues.append({
+                'source': record['source'], 'issue': issue,
+                'detail': {
+                    'box': box_index,
+                    'label': record['labels'][box_index],
+                    'bndbox': [
+                        None if np.isnan(value) else value
+                        for value in record['boxes'][box_index].tolist()],
+                }})
+
+    counts = collections.Counter(issue['issue'] for issue in issues)
+    return {
+        'input': input_dir,
+        'files': len(records),
+        'boxes': sum(len(record['boxes']) for record in records),
+        'files_with_issues': len(set(issue['source'] for issue in issues)),
+        'issue_counts': dict(counts.most_common()),
+        'seconds': time.perf_counter() - start,
+        'issues': issues,
+    }
+
+
+def main(input_dir, report_path=None, workers=1, tolerance=0.0,
+         min_size=1.0):
+    if not os.path.exists(input_dir):
+        raise RuntimeError("Invalid input directory")
+    if report_path is None:
+        report_path = "{}_validation.json".format(
+            os.path.splitext(os.path.basename(input_dir.rstrip(os.sep)))[0])
+
+    print("Validating {}...".format(input_dir))
+    report = validate(input_dir, workers, tolerance, min_size)
+    print("Checked {} boxes in {} annotation files in {:.1f}s.".format(
+        report['boxes'], report['files'], report['seconds']))
+    print("{} files with issues.".format(report['files_with_issues']))
+    for issue, count in report['issue_counts'].items():
+        print("\t{}: {}".format(issue, count))
+
+    with open(report_path, 'w') as f:
+        # bare NaN is not JSON; every value is meant to be plain already
+        json.dump(report, f, indent=2, allow_nan=False)
+    print("Report written to {}".format(report_path))
+    print("Done.")
+
+
+if __name__ == "__main__":
+    try:
+        parser = argparse.ArgumentParser(
+            description='alwaysAI Annotation Validation Module')
+        parser.add_argument(
+                '--input_dir', type=str,
+                help='The dataset to validate; a zip file, or a folder, of an Annotation folder, in Pascal VOC, and a JPEGImages folder.')
+        parser.add_argument(
+                '--report', type=str,
+                help='Path of the JSON report. <input>_validation.json is used if not specified.')
+        parser.add_argument(
+                '--workers', type=int, default=1,
+                help='The number of worker processes reading annotations.')
+        parser.add_argument(
+                '--tolerance', type=float, default=0.0,
+                help='Pixels a box may extend past the image border.')
+        parser.add_argument(
+                '--min_size', type=float, default=1.0,
+                help='The smallest valid box width and height, in pixels.')
+
+        args = parser.parse_args()
+        main(args.input_dir, args.report, args.workers, args.tolerance,
+             args.min_size)
+    except RuntimeError as err:
+        print(err)
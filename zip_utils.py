@@ -0,0 +1,251 @@
+import os
+import posixpath
+import struct
+import time
+import zipfile
+import zlib
+
+# Already-compressed formats gain nothing from deflate, so store them as-is
+STORED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+# Zip flag bits, see the PKWARE APPNOTE section 4.4.4
+_FLAG_ENCRYPTED = 0x1
+_FLAG_DATA_DESCRIPTOR = 0x8
+
+ANNOTATION_DIR = 'Annotations'
+IMAGE_DIR = 'JPEGImages'
+
+
+def is_annotation_member(name):
+    """
+    Checks whether a zip member is a Pascal VOC annotation file
+    """
+    return name.endswith('.xml') and \
+        posixpath.basename(posixpath.dirname(name)) == ANNOTATION_DIR
+
+
+def image_member(annotation_member, image_name):
+    """
+    Gets the JPEGImages member next to an Annotations member
+    """
+    return posixpath.join(
+        posixpath.dirname(posixpath.dirname(annotation_member)),
+        IMAGE_DIR, image_name)
+
+
+class DatasetReader:
+    """
+    Reads the members of a Pascal VOC dataset by their zip member names,
+    from a zip file without extracting it, or from an extracted folder
+    """
+    def __init__(self, source):
+        self.source = source
+        self.zip = None
+        if zipfile.is_zipfile(source):
+            self.zip = zipfile.ZipFile(source, 'r')
+        elif not os.path.isdir(source):
+            raise RuntimeError("Invalid input directory {}".format(source))
+
+    def annotation_members(self):
+        """
+        Lists the annotation members, from the zip's central directory
+        :return: sorted list of member names
+        """
+        if self.zip is not None:
+            names = self.zip.namelist()
+        else:
+            names = [
+                os.path.relpath(
+                    os.path.join(root, filename), self.source).replace(
+                        os.sep, '/')
+                for root, _, files in os.walk(self.source)
+                if os.path.basename(root) == ANNOTATION_DIR
+                for filename in files]
+        return sorted(name for name in names if is_annotation_member(name))
+
+    def open(self, member):
+        """
+        :return: a binary file object of the member; a zip member is only
+            decompressed as far as it is read
+        """
+        try:
+            if self.zip is not None:
+                return self.zip.open(member)
+            return open(os.path.join(self.source, *member.split('/')), 'rb')
+        except (KeyError, IOError, OSError):
+            raise RuntimeError("Missing member {}".format(member))
+
+    def read(self, member):
+        """
+        :return: the contents of a member as bytes, decompressed in memory
+        """
+        with self.open(member) as f:
+            return f.read()
+
+    def close(self):
+        if self.zip is not None:
+            self.zip.close()
+
+
+def copy_raw_member(source, target, info, name=None):
+    """
+    Copies a member from one open zip file to another without decompressing
+    or recompressing its data
+    :param source: the zipfile.ZipFile to read from
+    :param target: the zipfile.ZipFile to write to, opened with mode 'w'
+    :param info: the zipfile.ZipInfo of the member to copy
+    :param name: optional new name for the copied member
+    """
+    if info.flag_bits & _FLAG_ENCRYPTED:
+        raise RuntimeError(
+            "Encrypted zip member {} is not supported".format(info.filename))
+
+    # zipfile has no public raw API, so skip the local header by hand and
+    # read the compressed bytes straight from the archive
+    with source._lock:
+        source.fp.seek(info.header_offset)
+        header = source.fp.read(zipfile.sizeFileHeader)
+        if len(header) != zipfile.sizeFileHeader or \
+                header[:4] != zipfile.stringFileHeader:
+            raise RuntimeError(
+                "Bad local header for zip member {}".format(info.filename))
+        header = struct.unpack(zipfile.structFileHeader, header)
+        source.fp.seek(
+            header[zipfile._FH_FILENAME_LENGTH] +
+            header[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+        data = source.fp.read(info.compress_size)
+
+    copy = zipfile.ZipInfo(name or info.filename, info.date_time)
+    copy.compress_type = info.compress_type
+    copy.CRC = info.CRC
+    copy.compress_size = info.compress_size
+    copy.file_size = info.file_size
+    copy.external_attr = info.external_attr
+    copy.create_system = info.create_system
+    # sizes and CRC go in the local header, so no data descriptor follows
+    copy.flag_bits = info.flag_bits & ~_FLAG_DATA_DESCRIPTOR
+
+    with target._lock:
+        if target._writing:
+            raise RuntimeError(
+                "Can't copy {} while another member is being written".format(
+                    copy.filename))
+        target._writecheck(copy)
+        target._didModify = True
+        target.fp.seek(target.start_dir)
+        copy.header_offset = target.fp.tell()
+        target.fp.write(copy.FileHeader())
+        target.fp.write(data)
+        target.start_dir = target.fp.tell()
+        target.filelist.append(copy)
+        target.NameToInfo[copy.filename] = copy
+
+
+def write_member(target, name, data):
+    """
+    Writes new data to an open zip file, storing already-compressed images
+    and deflating everything else
+    :param target: the zipfile.ZipFile to write to, opened with mode 'w'
+    :param name: the member name
+    :param data: the member contents as bytes
+    """
+    info = zipfile.ZipInfo(name, time.localtime()[:6])
+    info.external_attr = 0o644 << 16
+    if os.path.splitext(name)[1].lower() in STORED_EXTENSIONS:
+        info.compress_type = zipfile.ZIP_STORED
+    else:
+        info.compress_type = zipfile.ZIP_DEFLATED
+    target.writestr(info, data)
+
+
+def merge_zip(source_path, target):
+    """
+    Appends every member of a zip file to an open zip file as raw
+    compressed data
+    :param source_path: path of the zip file to copy from
+    :param target: the zipfile.ZipFile to write to, opened with mode 'w'
+    """
+    with zipfile.ZipFile(source_path, 'r') as source:
+        for info in source.infolist():
+            copy_raw_member(source, target, info)
+
+
+def _intact(header, data):
+    """
+    Checks the data of a member against the sizes and CRC of its local
+    header
+    """
+    if len(data) != header[zipfile._FH_COMPRESSED_SIZE]:
+        return False
+    method = header[zipfile._FH_COMPRESSION_METHOD]
+    if method == zipfile.ZIP_STORED:
+        content = data
+    elif method == zipfile.ZIP_DEFLATED:
+        try:
+            content = zlib.decompress(data, -15)
+        except zlib.error:
+            return False
+    else:
+        return False
+    return len(content) == header[zipfile._FH_UNCOMPRESSED_SIZE] and \
+        zlib.crc32(content) == header[zipfile._FH_CRC]
+
+
+def recover_zip(path):
+    """
+    Makes a zip file whose writing was interrupted, before its central
+    directory was written, readable again. The members are found by their
+    local headers, which this module and zipfile write with their final
+    sizes and CRC, and every member written in full is kept. The file is
+    truncated after the last of them and a new central directory appended.
+    :param path: path of the interrupted zip file
+    :return: the number of members recovered
+    """
+    infos = []
+    end = 0
+    with open(path, 'rb') as f:
+        while True:
+            f.seek(end)
+            header = f.read(zipfile.sizeFileHeader)
+            if len(header) != zipfile.sizeFileHeader or \
+                    header[:4] != zipfile.stringFileHeader:
+                break
+            header = struct.unpack(zipfile.structFileHeader, header)
+            flags = header[zipfile._FH_GENERAL_PURPOSE_FLAG_BITS]
+            if flags & (_FLAG_ENCRYPTED | _FLAG_DATA_DESCRIPTOR):
+                break
+            name = f.read(header[zipfile._FH_FILENAME_LENGTH])
+            f.seek(header[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+            # a member cut off mid-write still has the placeholder header
+            # zipfile writes before its data
+            if not _intact(header, f.read(header[zipfile._FH_COMPRESSED_SIZE])):
+                break
+
+            info = zipfile.ZipInfo(
+                name.decode('utf-8' if flags & 0x800 else 'cp437'),
+                ((header[zipfile._FH_LAST_MOD_DATE] >> 9) + 1980,
+                 (header[zipfile._FH_LAST_MOD_DATE] >> 5) & 0xF,
+                 header[zipfile._FH_LAST_MOD_DATE] & 0x1F,
+                 header[zipfile._FH_LAST_MOD_TIME] >> 11,
+                 (header[zipfile._FH_LAST_MOD_TIME] >> 5) & 0x3F,
+                 (header[zipfile._FH_LAST_MOD_TIME] & 0x1F) * 2))
+            info.flag_bits = flags
+            info.compress_type = header[zipfile._FH_COMPRESSION_METHOD]
+            info.CRC = header[zipfile._FH_CRC]
+            info.compress_size = header[zipfile._FH_COMPRESSED_SIZE]
+            info.file_size = header[zipfile._FH_UNCOMPRESSED_SIZE]
+            info.external_attr = 0o644 << 16
+            info.header_offset = end
+            infos.append(info)
+            end = f.tell()
+
+    with open(path, 'r+b') as f:
+        f.truncate(end)
+    # appending to a file that is not a zip yet starts a new archive at its
+    # end, whose central directory then lists the recovered members
+    with zipfile.ZipFile(path, 'a') as target:
+        target._start_disk = 0
+        for info in infos:
+            target.filelist.append(info)
+            target.NameToInfo[info.filename] = info
+    return len(infos)